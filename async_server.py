@@ -0,0 +1,159 @@
+"""
+The async_server module runs the game server on an asyncio event loop
+instead of a select loop. Game handling is shared with server.Server,
+only the socket handling differs.
+
+Authors: Tomass Wilson
+"""
+import asyncio
+import logging
+import socket
+from comms import Decoder, CLIENT_MESSAGES
+from metrics import http_response
+from server import Server
+
+
+class AsyncServer(Server):
+    """A server where each client has its own reader and writer task.
+    Clients are identified by their asyncio StreamWriter."""
+
+    def __init__(self, loop_factory=None, port=26000, tick=None,
+                 limits=None, metrics_port=None, journal=None,
+                 world=None):
+        Server.__init__(self, port, tick, limits, metrics_port, journal,
+                        world)
+        self.loop_factory = loop_factory
+        self.wakeups = {}
+        self.writer_tasks = {}
+        self.done = None
+
+    def listen(self):
+        """Serve clients until the game has been won"""
+        with asyncio.Runner(loop_factory=self.loop_factory) as runner:
+            runner.run(self.serve())
+        if self.journal is not None:
+            self.journal.close()
+
+    async def serve(self):
+        """Accept clients on the listening socket until the game is won"""
+        self.done = asyncio.Event()
+        server = await asyncio.start_server(self.serve_client,
+                                            sock=self.sckt,
+                                            backlog=socket.SOMAXCONN)
+        tasks = [asyncio.create_task(self.lag_loop())]
+        if self.tick:
+            tasks.append(asyncio.create_task(self.tick_loop()))
+        if self.admin is not None:
+            admin = await asyncio.start_server(self.serve_admin,
+                                               sock=self.admin)
+            tasks.append(asyncio.create_task(admin.serve_forever()))
+        async with server:
+            await self.done.wait()
+        for task in tasks:
+            task.cancel()
+        for task in list(self.writer_tasks.values()):
+            task.cancel()
+
+    async def tick_loop(self):
+        """Send the delta of every tick at a fixed rate"""
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            next_tick = max(next_tick + self.tick, loop.time())
+            await asyncio.sleep(next_tick - loop.time())
+            self.send_delta()
+
+    async def lag_loop(self, interval=0.1):
+        """Measure how late the event loop runs a task that should wake
+        every interval seconds, as the loop latency"""
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            self.loop_seconds.observe(max(0, loop.time() - start - interval))
+
+    async def serve_admin(self, reader, writer):
+        """Answer any request on the metrics port with the metrics"""
+        try:
+            await reader.read(4096)
+            writer.write(http_response(self.metrics))
+            await writer.drain()
+        except OSError:
+            pass
+        writer.close()
+
+    async def serve_client(self, reader, writer):
+        """Read and handle messages from a single client"""
+        logging.info('new connection from %s', self.peer(writer))
+        self.outboxes[writer] = []
+        self.decoders[writer] = Decoder(accept=CLIENT_MESSAGES)
+        self.wakeups[writer] = asyncio.Event()
+        self.writer_tasks[writer] = asyncio.create_task(self.write_loop(writer))
+        try:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                decoder = self.decoders[writer]
+                self.handle_frames(writer, decoder.feed(data), decoder.sizes)
+        except ConnectionResetError:
+            pass
+        except Exception:  # only this client goes, not the room
+            logging.exception('failed handling "%s", closing it',
+                              self.client_names.get(writer))
+        if writer in self.outboxes:
+            logging.info('closing connection of "%s"',
+                         self.client_names.get(writer))
+            self.remove_client(writer)
+
+    async def write_loop(self, writer):
+        """Write out queued messages whenever the client is woken"""
+        wakeup = self.wakeups[writer]
+        try:
+            while True:
+                await wakeup.wait()
+                wakeup.clear()
+                frames = self.outboxes[writer]
+                self.outboxes[writer] = []
+                writer.writelines(frames)
+                await writer.drain()
+                if self.win and self.all_sent():
+                    self.done.set()
+        except OSError:
+            logging.info('closing connection of "%s" after failed send',
+                         self.client_names.get(writer))
+            self.remove_client(writer)
+
+    def all_sent(self):
+        """True if no client has messages waiting"""
+        for writer, outbox in self.outboxes.items():
+            if outbox:
+                return False
+            if writer.transport.get_write_buffer_size():
+                return False
+        return True
+
+    def wake(self, sckt):
+        self.wakeups[sckt].set()
+
+    def forget(self, sckt):
+        del self.outboxes[sckt]
+        del self.decoders[sckt]
+        del self.wakeups[sckt]
+        task = self.writer_tasks.pop(sckt)
+        if task is not asyncio.current_task():
+            task.cancel()
+        sckt.close()
+
+    def peer(self, sckt):
+        return sckt.get_extra_info('peername')
+
+    def fileno(self, sckt):
+        return sckt.get_extra_info('socket').fileno()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    SERVER = AsyncServer()
+    SERVER.listen()
+    print("The players have won!")
@@ -0,0 +1,230 @@
+"""
+The bench module times the hot paths of the game: message encoding and
+parsing, maze generation and conversion, the game calls made on joins and
+moves, and the server's fan out to many clients.
+
+Results can be saved as a json baseline and later runs compared against
+it, flagging every benchmark that got slower by more than a threshold:
+
+    python bench.py --save baseline.json
+    python bench.py --compare baseline.json
+
+Authors: Tomass Wilson
+"""
+import argparse
+import json
+import platform
+import socket
+import sys
+import time
+import timeit
+import comms
+import maze
+from comms import Msg
+from game_logic import Game, step
+from server import Server, pos_bytes
+
+BENCHMARKS = {}  # name -> function returning the callable to time
+
+
+def benchmark(name):
+    """Register a benchmark. The decorated function does the setup and
+    returns the callable that is timed"""
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def measure(func, repeat=5):
+    """Seconds per call of func, the best of repeat rounds of at least
+    0.2 seconds each"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+MESSAGES = {
+    b'M': Msg(b'M', "somebody> hello there"),
+    b'm': Msg(b'm', "somebody", 2),
+    b'n': Msg(b'n', "somebody", pos_bytes(7, 11)),
+    b'k': Msg(b'k', pos_bytes(7, 11)),
+    b'p': Msg(b'p', 300, 2),
+    b'i': Msg(b'i', "somebody", (300, 700, 1100)),
+    b'K': Msg(b'K', (700, 1100)),
+    b'b': Msg(b'b', maze.generate(15, 21, seed=1)),
+    b'w': Msg(b'w', maze.generate(15, 21, seed=1).render()),
+    b'D': Msg(b'D', ([1, 2], [(3, "somebody", 7, 11)],
+                     [(n, n % 15, n % 21) for n in range(50)],
+                     [(5, 5, 0), (6, 6, 1)])),
+}
+
+
+def _comms_benchmarks():
+    for msg_type, msg in MESSAGES.items():
+        def encode(msg=msg):
+            return msg.encode
+        def parse(msg=msg):
+            frame = msg.encode()
+            view = memoryview(frame)
+            return lambda: comms._parse(view, 0, len(frame))
+        benchmark("comms.encode.%s" % msg_type.decode())(encode)
+        benchmark("comms.parse.%s" % msg_type.decode())(parse)
+
+
+_comms_benchmarks()
+
+SIZES = [(15, 21), (63, 63), (255, 255)]
+
+
+def _maze_benchmarks():
+    for rows, cols in SIZES:
+        def make(rows=rows, cols=cols):
+            return lambda: maze.make_maze(cols, rows, seed=1)
+        def draw(rows=rows, cols=cols):
+            board = maze.generate(rows, cols, seed=1)
+            # a new board every call, render is cached per board
+            return lambda: maze.draw_maze(maze.Board(board.hor, board.ver))
+        def read(rows=rows, cols=cols):
+            text = maze.make_maze(cols, rows, seed=1)
+            return lambda: maze.read_maze(text)
+        size = "%dx%d" % (rows, cols)
+        benchmark("maze.make_maze." + size)(make)
+        benchmark("maze.draw_maze." + size)(draw)
+        benchmark("maze.read_maze." + size)(read)
+
+
+_maze_benchmarks()
+
+
+def crowded_game(rows, cols, players, keys=0):
+    """A game on a fixed board with players and keys spread over it"""
+    game = Game()
+    game.rows, game.cols = rows, cols
+    game.genboard(seed=1)
+    for num in range(players):
+        y, x = divmod(num * 7919 % (rows * cols), cols)
+        game.add_player("p%d" % num, y, x)
+    for num in range(keys):
+        y, x = divmod(num * 104729 % (rows * cols), cols)
+        if (y, x) not in game.occupied:
+            game.toggle_key(y, x)
+    return game
+
+
+@benchmark("game.distance_grid.63x63")
+def distance_grid():
+    game = crowded_game(63, 63, 0)
+    return lambda: game.distance_grid(31, 31)
+
+
+@benchmark("game.get_common_furthest.15x21.20p20k")
+def get_common_furthest():
+    game = crowded_game(15, 21, 20, 20)
+    return game.get_common_furthest
+
+
+@benchmark("game.spawn_keys.15x21.8p")
+def spawn_keys():
+    game = crowded_game(15, 21, 8)
+
+    def spawn():
+        game.keys = {}
+        game.keys_spawned = False
+        game.spawn_keys()
+    return spawn
+
+
+@benchmark("game.move_check_key.63x63.500p200k")
+def move_check_key():
+    game = crowded_game(63, 63, 500, 200)
+    name = "p0"
+    y, x = game.players[name].pos
+    direction = next(d for d in range(4) if not game.wall(y, x, d)
+                     and step(y, x, d) not in game.occupied)
+    there = (direction, (direction + 2) % 4)
+
+    def move():
+        for direction in there:  # there and back again
+            game.move(name, direction)
+            game.check_key(name)
+    return move
+
+
+def _server_benchmarks():
+    for clients in (10, 100):
+        def fan_out(clients=clients):
+            server = Server(port=None)
+            peers = []
+            for _ in range(clients):
+                ours, theirs = socket.socketpair()
+                server.adopt(ours, None)
+                peers.append(theirs)
+            msg = Msg(b'M', "somebody> hello there")
+
+            def send_all():
+                server.send_all(msg)
+                server.write(list(server.clients_to_send))
+                for peer in peers:
+                    peer.recv(4096)
+            return send_all
+        benchmark("server.send_all.%d" % clients)(fan_out)
+
+
+_server_benchmarks()
+
+
+def run(names, repeat):
+    """Time the named benchmarks, returns name -> seconds per call"""
+    results = {}
+    for name in names:
+        results[name] = measure(BENCHMARKS[name](), repeat)
+        print("%-45s %12.3f us" % (name, results[name] * 1e6))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print the change against a baseline, returns the names of the
+    benchmarks that got slower by more than threshold"""
+    regressions = []
+    for name, seconds in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        ratio = seconds / old
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "REGRESSION"
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            flag = "faster"
+        print("%-45s %+8.1f%% %s" % (name, (ratio - 1) * 100, flag))
+    return regressions
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    PARSER.add_argument('-k', dest='match', default='',
+                        help='only run benchmarks whose name contains this')
+    PARSER.add_argument('--repeat', type=int, default=5,
+                        help='rounds per benchmark, the best one counts')
+    PARSER.add_argument('--save', metavar='FILE',
+                        help='save the results as a json baseline')
+    PARSER.add_argument('--compare', metavar='FILE',
+                        help='compare the results with a saved baseline')
+    PARSER.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown flagged as a regression, 0.1 is 10%%')
+    ARGS = PARSER.parse_args()
+
+    NAMES = [name for name in BENCHMARKS if ARGS.match in name]
+    RESULTS = run(NAMES, ARGS.repeat)
+    if ARGS.save:
+        with open(ARGS.save, "w") as out:
+            json.dump({"python": sys.version, "platform": platform.platform(),
+                       "time": time.time(), "results": RESULTS},
+                      out, indent=2)
+    if ARGS.compare:
+        with open(ARGS.compare) as saved:
+            BASELINE = json.load(saved)["results"]
+        if compare(RESULTS, BASELINE, ARGS.threshold):
+            sys.exit(1)
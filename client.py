@@ -1,17 +1,28 @@
+import argparse
 import socket
 import logging
-import threading
+import selectors
 import sys
-import queue
+import collections
+import contextlib
 from screen import Screen
-from comms import receive, Msg
+from comms import receive, Msg, Decoder, send_frames, PROTOCOL_VERSION
+from game_logic import step
+import maze
 
 logging.basicConfig(level=logging.WARNING)
 
 
 class Client():
-    def __init__(self):
-        self.screen = Screen(self, self)
+    """A game client. After joining, the server socket and the keyboard
+    are both watched by one selector, so a single thread reads server
+    messages, moves, chat input and draws the screen. The screen is
+    drawn at most fps times a second. protocol is the highest protocol
+    version asked for when joining; servers from before version 2 do not
+    know the versioned join, and need a client joining with 1."""
+
+    def __init__(self, fps=30, protocol=PROTOCOL_VERSION):
+        self.screen = Screen(self, self, fps)
         self.server_address = ('81.229.8.57', 26000)
 
         # Create a TCP/IP socket
@@ -22,32 +33,32 @@ class Client():
                       self.server_address[1])
         self.sckt.connect(self.server_address)
 
+        self.protocol = protocol
+        self.version = 1  # protocol version agreed with the server
+        self.player_id = None
         self.name = self.welcome()
-        maze = self.join()
-        self.screen.start_game(maze)
+        maze, origin = self.join()
+        self.screen.start_game(maze, origin)
 
         self.screen.chat.set_prompt(self.name + "> ")
 
-        self.bucket = queue.Queue()
-
-        self.stop_threads = False
-        stop = lambda : self.stop_threads
-
-        chatter = Chatterer(self.bucket, self.name, self.screen,
-                            self.sckt, stop)
-        # chatter.run()
-
-        input_listener = Inputter(self.bucket, self.name,
-                                  self.screen, self.sckt, stop)
-        input_listener.start()
-
-        listener = Listener(self.bucket, self.name, self.screen,
-                            self.sckt, stop)
-        listener.start()
+        self.ids = {}  # player id -> name, for protocol version 3
+        self.prediction = Prediction(self.screen.game.game, self.name)
+        self.decoder = Decoder()
+        self.outbox = []
+        self.waiting = False  # outbox not empty, socket watched for writes
+        self.selector = selectors.DefaultSelector()
+        self.win = False
 
         self.screen.refresh()
-        self.threads = [input_listener, listener]
-        self.mainloop()
+        try:
+            self.mainloop()
+        except Exception:
+            self.screen.print_exc(sys.exc_info())
+        if self.win:
+            self.screen.win()
+        else:
+            self.screen.lost()
 
     def welcome(self):
         """display a welcome splash screen"""
@@ -56,135 +67,228 @@ class Client():
         return name
 
     def join(self):
-        """Send a join request to the server, and recieve the maze"""
-        msg = Msg(b'j', self.name)
+        """Send a join request to the server, and recieve the maze as a
+        maze.Board and the position of its first cell, which is not (0, 0)
+        for a page of a world"""
+        if self.protocol >= 2:
+            msg = Msg(b'J', self.name, self.protocol)
+        else:
+            msg = Msg(b'j', self.name)
         msg.send(self.sckt)
         msg_type, msg = receive(self.sckt)
-        if msg_type == b'w':
-            return msg
+        if msg_type == b'v':  # server speaks a newer protocol
+            self.version, self.player_id = msg
+            msg_type, msg = receive(self.sckt)
+        if msg_type == b'b':
+            return msg, (0, 0)
+        if msg_type == b'R':  # the page of a world the player is on
+            return msg[0], (msg[1], msg[2])
+        if msg_type == b'w':  # server without compact boards
+            return maze.read_maze(msg), (0, 0)
         if (msg_type == b's') and (msg == "T"):
             self.name = self.welcome()
             return self.join()  # Try again. TODO: add new name prompt
         self.screen.print_debug("failed to join, no maze received\nInstead"
                                 " received type " + str(msg_type)
                                 + " with data " + str(msg))
-        return None  # Connection refused, assume name taken
+        return None, (0, 0)  # Connection refused, assume name taken
 
     def mainloop(self):
-        exc = None
-        win = False
-        while not win:
-            try:
-                exc = self.bucket.get(block=False)
-            except queue.Empty:
-                pass
-
-            for thread in self.threads:
-                thread.join(0.1)
-                if thread.is_alive():
+        """Wait for server messages, key presses and due screen frames
+        until the game is won or the server closes the connection"""
+        self.sckt.setblocking(False)
+        self.screen.start_input()
+        self.selector.register(self.sckt, selectors.EVENT_READ)
+        self.selector.register(sys.stdin, selectors.EVENT_READ)
+        connected = True
+        while connected and not self.win:
+            for key, events in self.selector.select(self.screen.timeout()):
+                if key.fileobj is sys.stdin:
+                    self.read_input()
                     continue
-                win = True
-                break
-            if exc is not None:
-                break
-
-        if exc is not None:
-            self.screen.print_exc(exc)
-        elif win:
-            self.stop_threads = True
-            self.screen.win()
-
-
-class Client_thread(threading.Thread):
-    def __init__(self, bucket, name, screen, sckt, stop):
-        threading.Thread.__init__(self)
-        self.bucket = bucket
-        self.name = name
-        self.screen = screen
-        self.sckt = sckt
-        self.stop = stop
-        self.setDaemon(True)
-
-    def run(self):
+                if events & selectors.EVENT_READ:
+                    connected = self.read_server()
+                if connected and events & selectors.EVENT_WRITE:
+                    self.write()
+            self.screen.draw_due()
+        self.selector.close()
+        self.sckt.close()
+
+    def read_server(self):
+        """Handle every message the server has sent, False once the
+        server has closed the connection"""
         try:
-            self.mainloop()
-        except Exception:
-            self.bucket.put(sys.exc_info())
-
-    def mainloop(self):
-        """The looped thread action"""
-
-
-class Chatterer(Client_thread):
-    def __init__(self, bucket, name, screen, sckt, stop):
-        Client_thread.__init__(self, bucket, name, screen, sckt, stop)
-
-    def mainloop(self):
-        """wait for input on the chat window, and send message"""
-        while True:
-            msg = self.name + "> " + self.screen.chat.getinp()
-            msg = Msg(b'M', msg)
-            # Send messages on socket
-            msg.send(self.sckt)
-            if self.stop():
-                break
-
-
-class Listener(Client_thread):
-    def __init__(self, bucket, name, screen, sckt, stop):
-        Client_thread.__init__(self, bucket, name, screen, sckt, stop)
-
-    def mainloop(self):
-        """Listen for incoming commands from the server"""
-        while True:
-            try:
-                msg_type, data = receive(self.sckt)
-            except ConnectionResetError:  # Server closed
-                logging.info('closing %s after reading no data',
-                             self.sckt.getpeername())
-                self.sckt.close()
-                break
-            logging.debug('%s: received "%s"', self.sckt.getsockname(), data)
+            frames = self.decoder.recv(self.sckt)
+        except ConnectionResetError:  # Server closed
+            logging.info('closing %s after reading no data',
+                         self.sckt.getpeername())
+            return False
+        for msg_type, data in frames:
+            logging.debug('received "%s"', data)
             if msg_type == b'M':
                 self.screen.chat.print_line(data)
-            elif msg_type == b'n':  # new player joined
-                self.screen.game.game.add_player(data[0], data[1], data[2])
-                self.screen.refresh()
-            elif msg_type == b'm':  # move a player
-                self.screen.game.game.move(data[0], int(data[1]))
-                self.screen.refresh()
-            elif msg_type == b'd':  # delete a player
-                self.screen.game.game.delete_player(data)
-                self.screen.refresh()
-            elif msg_type == b'k':
-                self.screen.game.game.toggle_key(data[0], data[1])
-                self.screen.refresh()
-            elif msg_type == b's':
-                if data == "I":  # illegal move
-                    pass
-                if data == "W":
-                    break
-            if self.stop():
+            elif msg_type == b's' and data == "W":
+                self.win = True
                 break
-
-class Inputter(Client_thread):
-    def __init__(self, bucket, name, screen, sckt, stop):
-        Client_thread.__init__(self, bucket, name, screen, sckt, stop)
-
-    def mainloop(self):
-        while True:
-            direction = self.screen.getdir()
-            if direction is None:
+            else:
+                with self.prediction.update():
+                    self.apply(msg_type, data)
+        self.screen.refresh()
+        return True
+
+    def apply(self, msg_type, data):
+        """Apply a message that changes the game state"""
+        game = self.screen.game.game
+        if msg_type == b'n':  # new player joined
+            game.add_player(data[0], data[1], data[2])
+        elif msg_type == b'm':  # move a player
+            if data[0] == self.name:
+                self.prediction.answered(int(data[1]))
+            else:
+                game.move(data[0], int(data[1]))
+        elif msg_type == b'd':  # delete a player
+            game.delete_player(data)
+        elif msg_type == b'k':
+            game.toggle_key(data[0], data[1])
+        elif msg_type == b'i':  # new player with id
+            name, player_id, y, x = data
+            self.ids[player_id] = name
+            game.add_player(name, y, x)
+        elif msg_type == b'p':  # move a player by id
+            if self.ids[data[0]] == self.name:
+                self.prediction.answered(data[1])
+            else:
+                game.move(self.ids[data[0]], data[1])
+        elif msg_type == b'x':  # delete a player by id
+            game.delete_player(self.ids.pop(data))
+        elif msg_type == b'K':
+            game.toggle_key(data[0], data[1])
+        elif msg_type == b'D':  # all changes of a server tick
+            self.apply_delta(*data)
+        elif msg_type == b'R':  # moved onto another page of the world
+            self.screen.game.set_maze(data[0], (data[1], data[2]))
+        elif msg_type == b's':
+            if data == "I":  # illegal move
+                self.prediction.answered()
+
+    def apply_delta(self, leaves, joins, moves, keys):
+        """Apply a tick delta. Positions and keys are absolute, so changes
+        already seen in the full state sent on join are harmless"""
+        game = self.screen.game.game
+        for player_id in leaves:
+            name = self.ids.pop(player_id, None)
+            if name in game.players:
+                game.delete_player(name)
+        for player_id, name, y, x in joins:
+            self.ids[player_id] = name
+            game.add_player(name, y, x)
+        for player_id, y, x in moves:
+            game.add_player(self.ids[player_id], y, x)
+        for y, x, present in keys:
+            game.set_key(y, x, present)
+
+    def read_input(self):
+        """Handle every key pressed, arrows move and anything else is
+        typed into the chat"""
+        for key in self.screen.getkeys():
+            direction = self.screen.getdir(key)
+            if direction is not None:
+                self.move_req(direction)
                 continue
-            self.move_req(direction)
-            if self.stop():
-                break
+            line = self.screen.chat.type_key(key)
+            if line:
+                msg = self.name + "> " + line
+                self.screen.chat.print_line(msg)
+                self.queue_msg(Msg(b'M', msg))
 
     def move_req(self, direction):
-        msg = Msg(b'm', self.name, direction)
-        msg.send(self.sckt)
+        """Show the move at once and send it to the server"""
+        self.prediction.predict(direction)
+        self.screen.refresh()
+        if self.version >= 3:
+            msg = Msg(b'p', self.player_id, direction)
+        else:
+            msg = Msg(b'm', self.name, direction)
+        self.queue_msg(msg)
+
+    def queue_msg(self, msg):
+        """Send a message, the rest once the socket is writable if it can
+        not all be sent now"""
+        self.outbox.append(msg.encode())
+        if not self.waiting:
+            self.write()
+
+    def write(self):
+        """Send as much of the outbox as the socket takes, and watch for
+        the socket becoming writable only while something is left"""
+        self.outbox = send_frames(self.sckt, self.outbox)
+        if bool(self.outbox) != self.waiting:
+            self.waiting = bool(self.outbox)
+            events = selectors.EVENT_READ
+            if self.waiting:
+                events |= selectors.EVENT_WRITE
+            self.selector.modify(self.sckt, events)
+
+
+class Prediction():
+    """
+    The own player's moves, shown before the server has answered them.
+
+    The server answers move requests in order, each with an echo of the
+    move or an illegal move status, so every answer is for the oldest
+    pending move. Server messages are applied with the own player rolled
+    back to the position the server knows, and the pending moves are
+    replayed on top afterwards.
+    """
+
+    def __init__(self, game, name):
+        self.game = game
+        self.name = name
+        self.seq = 0  # number of the last move sent
+        self.pending = collections.deque()  # (seq, direction) unanswered
+        self.server_pos = None
+
+    def predict(self, direction):
+        """Apply an own move locally, returns its sequence number"""
+        self.seq += 1
+        self.pending.append((self.seq, direction))
+        if self.name in self.game.players:
+            self.game.move(self.name, direction)
+        return self.seq
+
+    def answered(self, direction=None):
+        """The server answered the oldest pending move, with the direction
+        it moved the player in or None if the move was illegal. Only call
+        inside update."""
+        if self.pending:
+            seq, sent = self.pending.popleft()
+            if direction is not None and direction != sent:
+                logging.warning('move %d answered with direction %d, '
+                                'sent %d', seq, direction, sent)
+        if direction is not None and self.server_pos is not None:
+            self.game.add_player(self.name,
+                                 *step(*self.server_pos, direction))
+
+    @contextlib.contextmanager
+    def update(self):
+        """Apply a server message to the game in a with block"""
+        if self.server_pos is not None and self.name in self.game.players:
+            self.game.add_player(self.name, *self.server_pos)  # roll back
+        yield
+        plyr = self.game.players.get(self.name)
+        self.server_pos = None if plyr is None else plyr.pos
+        if plyr is not None:
+            for _, direction in self.pending:  # replay
+                self.game.move(self.name, direction)
 
 
 if __name__ == "__main__":
-    sys.setrecursionlimit(10000)
-    client = Client()
+    PARSER = argparse.ArgumentParser(description="The maze game client")
+    PARSER.add_argument('--fps', type=float, default=30,
+                        help='most frames drawn per second')
+    PARSER.add_argument('--protocol', type=int, default=PROTOCOL_VERSION,
+                        choices=range(1, PROTOCOL_VERSION + 1),
+                        help='protocol version to join with, 1 for servers '
+                        'that only know the original protocol')
+    ARGS = PARSER.parse_args()
+    client = Client(ARGS.fps, ARGS.protocol)
@@ -5,6 +5,25 @@ the wilson protokoll.
 Authors: Tomass Wilson
 """
 import logging
+import os
+import struct
+import zlib
+import maze
+
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 16
+MAZE_LEN = 2014  # length of the ascii maze in a welcome message
+PROTOCOL_VERSION = 3  # highest version sent in a J join request
+# flags, rows, cols and payload length of a compact board message
+BOARD_HEADER = struct.Struct('>BHHI')
+BOARD_ZLIB = 1  # board payload is zlib compressed
+MAX_BOARD_BYTES = 1 << 20  # largest unpacked board payload accepted
+MAX_VARINT_BYTES = 10  # enough for any 64 bit number
+# message types a client may send, servers refuse everything else
+CLIENT_MESSAGES = frozenset([b'j', b'J', b'm', b'p', b'a', b'M'])
+
+
+class ProtocolError(ConnectionResetError):
+    """Raised when a peer sends data that does not follow the protocol"""
 
 
 class Msg():
@@ -20,32 +39,139 @@ class Msg():
         args:
             sckt: The socket to send on
         """
+        logging.debug('%s: sending "%s"', sckt.getsockname(), self.msg)
+        _send_message(sckt, self.encode())
+
+    def encode(self):
+        """
+        Encode the message as a single wire frame
+
+        returns:
+            The complete frame, type byte included, as bytes
+        """
         msg = self.msg
-        logging.debug('%s: sending "%s"', sckt.getsockname(), msg)
-        _send_message(sckt, self.msg_type)
         if self.msg_type in (b'j', b'M', b'd'):  # utf-8 message
             msg = msg.encode("utf-8")
-            _send_message(sckt, len(msg).to_bytes(1, byteorder='big'))
+            parts = [len(msg).to_bytes(1, byteorder='big'), msg]
         elif self.msg_type in (b'm', b'a'):  # Two part message
             msg = msg.encode("utf-8")
-            _send_message(sckt, len(msg).to_bytes(1, byteorder='big'))
-            _send_message(sckt, msg)
-            msg = str(self.msg_2).encode("ascii")
+            parts = [len(msg).to_bytes(1, byteorder='big'), msg,
+                     str(self.msg_2).encode("ascii")]
         elif self.msg_type == b'n':
             msg = msg.encode("utf-8")
-            _send_message(sckt, len(msg).to_bytes(1, byteorder='big'))
-            _send_message(sckt, msg)
-            msg = self.msg_2  # preencoded coordinates
+            parts = [len(msg).to_bytes(1, byteorder='big'), msg,
+                     self.msg_2]  # preencoded coordinates
         elif self.msg_type == b'k':
-            msg = msg  # preencoded coordinates
+            parts = [msg]  # preencoded coordinates
+        elif self.msg_type == b'J':  # versioned join
+            msg = msg.encode("utf-8")
+            parts = [self.msg_2.to_bytes(1, byteorder='big'),
+                     len(msg).to_bytes(1, byteorder='big'), msg]
+        elif self.msg_type == b'b':  # maze.Board
+            parts = _encode_board(msg)
+        elif self.msg_type == b'v':  # agreed version and player id
+            parts = [msg.to_bytes(1, byteorder='big'), varint(self.msg_2)]
+        elif self.msg_type == b'i':  # new player, (id, y, x) in msg_2
+            msg = msg.encode("utf-8")
+            player_id, y, x = self.msg_2
+            parts = [varint(player_id), len(msg).to_bytes(1, byteorder='big'),
+                     msg, varint(y), varint(x)]
+        elif self.msg_type == b'p':  # move of player id msg
+            parts = [varint(msg), self.msg_2.to_bytes(1, byteorder='big')]
+        elif self.msg_type == b'x':  # delete player id msg
+            parts = [varint(msg)]
+        elif self.msg_type == b'K':  # key at (y, x)
+            parts = [varint(msg[0]), varint(msg[1])]
+        elif self.msg_type == b'R':  # part of a world at (y, x) in msg_2
+            parts = [varint(self.msg_2[0]), varint(self.msg_2[1])]
+            parts += _encode_board(msg)
+        elif self.msg_type == b'D':  # tick delta
+            parts = _encode_delta(*msg)
         else:  # simple ascii message
-            msg = msg.encode("ascii")
-        _send_message(sckt, msg)
+            parts = [msg.encode("ascii")]
+        return b''.join([self.msg_type] + parts)
+
+
+def varint(value):
+    """Encode a non-negative int in as few bytes as possible, 7 bits per
+    byte, least significant first, the top bit set on all but the last"""
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _encode_delta(leaves, joins, moves, keys):
+    """Parts of a tick delta message, each section prefixed with its
+    number of entries"""
+    parts = [varint(len(leaves))]
+    parts += [varint(player_id) for player_id in leaves]
+    parts.append(varint(len(joins)))
+    for player_id, name, y, x in joins:
+        name = name.encode("utf-8")
+        parts += [varint(player_id), len(name).to_bytes(1, byteorder='big'),
+                  name, varint(y), varint(x)]
+    parts.append(varint(len(moves)))
+    for player_id, y, x in moves:
+        parts += [varint(player_id), varint(y), varint(x)]
+    parts.append(varint(len(keys)))
+    for y, x, present in keys:
+        parts += [varint(y), varint(x), bytes([present])]
+    return parts
+
+
+def _encode_board(board):
+    """Header and payload of a compact board message, the payload is
+    compressed if that makes it smaller"""
+    payload = board.pack()
+    flags = 0
+    compressed = zlib.compress(payload, 9)
+    if len(compressed) < len(payload):
+        payload = compressed
+        flags |= BOARD_ZLIB
+    header = BOARD_HEADER.pack(flags, board.rows, board.cols, len(payload))
+    return [header, payload]
+
+
+def send_frames(sckt, frames):
+    """
+    Send encoded frames with as few system calls as the socket allows,
+    without blocking.
+
+    args:
+        sckt: A non-blocking socket
+        frames: A list of bytes-like frames, in order
+
+    returns:
+        The frames, or tails of frames, that could not be sent yet
+    """
+    while frames:
+        try:
+            sent = sckt.sendmsg(frames[:IOV_MAX])
+        except (BlockingIOError, InterruptedError):
+            return frames
+        if sent == 0:
+            raise ConnectionResetError("socket connection broken")
+        done = 0
+        for frame in frames:  # count the frames that went out entirely
+            if sent < len(frame):
+                break
+            sent -= len(frame)
+            done += 1
+        frames = frames[done:]
+        if sent:
+            frames[0] = memoryview(frames[0])[sent:]
+            return frames  # socket buffer full
+    return frames
 
 
 def receive(sckt):
     """
-    Recieve a request/message from another party
+    Recieve a request/message from another party. Only for blocking
+    sockets, non-blocking sockets should use a Decoder instead. Reads
+    exactly one frame, never more.
 
     args:
         sckt: The socket on which to receive
@@ -54,46 +180,338 @@ def receive(sckt):
         msg_type: The type of the message
         msg: The message in the form of a string.
     """
-    # get type
-    msg_type = _receive_type(sckt)
-    not_blck = sckt.gettimeout() == 0
-    sckt.setblocking(1)
-
-    if msg_type in (b'j', b'M', b'd'):  # Read a utf-8 message
-        msg_bytes = _receive_type(sckt)  # names can be up to 255 bytes long
-        msg_bytes = int.from_bytes(msg_bytes, byteorder='big')
-        msg = _receive_message(sckt, msg_bytes).decode("utf-8")
-
-    elif msg_type == b's':  # Move/action request, status msg
-        msg = _receive_message(sckt, 1).decode("ascii")
-
-    elif msg_type in (b'm', b'a'):  # receive named action/move
-        msg_bytes = _receive_type(sckt)
-        msg_bytes = int.from_bytes(msg_bytes, byteorder='big')
-        name = _receive_message(sckt, msg_bytes).decode("utf-8")
-        msg = _receive_message(sckt, 1).decode("ascii")
-        msg = [name, msg]  # two part message
-
-    elif msg_type == b'n':  # new player message
-        msg_bytes = _receive_type(sckt)
-        msg_bytes = int.from_bytes(msg_bytes, byteorder='big')
-        name = _receive_message(sckt, msg_bytes).decode("utf-8")
-        y = int.from_bytes(_receive_message(sckt, 1), byteorder='big')
-        x = int.from_bytes(_receive_message(sckt, 1), byteorder='big')
-        msg = [name, y, x]  # three part message
-
-    elif msg_type == b'k':
-        y = int.from_bytes(_receive_message(sckt, 1), byteorder='big')
-        x = int.from_bytes(_receive_message(sckt, 1), byteorder='big')
-        msg = [y, x]  # two part message
-
-    elif msg_type == b'w':  # Maze message
-        msg = _receive_message(sckt, 2014).decode("ascii")
-
-    if not_blck:
-        sckt.setblocking(0)
-
-    return (msg_type, msg)
+    buf = bytearray(_receive_type(sckt))
+    while True:
+        frame = _parse(memoryview(buf), 0, len(buf))
+        if not isinstance(frame, int):
+            return frame[:2]
+        buf += _receive_message(sckt, frame)
+
+
+class Decoder():
+    """
+    Incremental frame decoder for a single non-blocking connection.
+
+    Everything available on the socket is read into one reusable buffer,
+    all complete frames are parsed out of it and any trailing partial
+    frame is kept until the next time the socket is readable.
+    """
+
+    def __init__(self, size=4096, accept=None):
+        self.accept = accept  # allowed message types, None for all
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0  # first unparsed byte
+        self.end = 0  # end of received data
+        self.sizes = []  # sizes of the frames last returned
+
+    def recv(self, sckt):
+        """
+        Read all data currently available on sckt without blocking
+
+        args:
+            sckt: A non-blocking socket that select reported readable
+
+        returns:
+            A list of (msg_type, msg) tuples, may be empty if only part of
+            a frame has arrived.
+        """
+        while True:
+            if self.end == len(self.buf):
+                self._make_room()
+            try:
+                nbytes = sckt.recv_into(self.view[self.end:])
+            except (BlockingIOError, InterruptedError):
+                break
+            if nbytes == 0:
+                frames = self.frames()
+                if not frames:
+                    raise ConnectionResetError("socket connection broken")
+                return frames  # report the close on the next read
+            self.end += nbytes
+            if self.end < len(self.buf):
+                break  # short read, the socket has been drained
+        return self.frames()
+
+    def feed(self, data):
+        """Add already received bytes and return the decoded frames"""
+        while len(self.buf) - self.end < len(data):
+            self._make_room()
+        self.buf[self.end:self.end + len(data)] = data
+        self.end += len(data)
+        return self.frames()
+
+    def pending(self):
+        """The received bytes of a frame that has not fully arrived"""
+        return bytes(self.view[self.start:self.end])
+
+    def frames(self):
+        """Parse every complete frame held in the buffer"""
+        frames = []
+        self.sizes = []
+        while self.start < self.end:
+            if self.accept is not None and \
+                    bytes(self.view[self.start:self.start + 1]) \
+                    not in self.accept:
+                raise ProtocolError("unexpected message type %r"
+                                    % bytes(self.view[self.start:
+                                                      self.start + 1]))
+            try:
+                frame = _parse(self.view, self.start, self.end)
+            except ValueError as exc:  # bad utf-8 or ascii too
+                raise ProtocolError("malformed %r message: %s"
+                                    % (bytes(self.view[self.start:
+                                                       self.start + 1]),
+                                       exc)) from exc
+            if isinstance(frame, int):
+                break
+            msg_type, msg, start = frame
+            frames.append((msg_type, msg))
+            self.sizes.append(start - self.start)
+            self.start = start
+        if self.start == self.end:
+            self.start = self.end = 0
+        return frames
+
+    def _make_room(self):
+        """Move unparsed data to the front of the buffer, or grow it"""
+        if self.start > 0:
+            pending = self.end - self.start
+            self.buf[:pending] = self.buf[self.start:self.end]
+            self.start, self.end = 0, pending
+        else:
+            self.view.release()
+            self.buf.extend(bytes(len(self.buf)))
+            self.view = memoryview(self.buf)
+
+
+def _parse(view, pos, end):
+    """
+    Parse one frame from view[pos:end].
+
+    returns:
+        (msg_type, msg, next_pos) if a complete frame is available,
+        otherwise the number of bytes that are at least still missing.
+    """
+    msg_type = bytes(view[pos:pos + 1])
+    pos += 1
+    if msg_type == b'J':  # versioned join, the version comes first
+        if end - pos < 1:
+            return 1
+        version = view[pos]
+        frame = _parse_named(view, pos + 1, end, 0)
+        if isinstance(frame, int):
+            return frame
+        name, pos = frame
+        return (msg_type, [name, version], pos)
+
+    if msg_type in (b'j', b'M', b'd', b'm', b'a', b'n'):
+        tail = {b'm': 1, b'a': 1, b'n': 2}.get(msg_type, 0)
+        frame = _parse_named(view, pos, end, tail)
+        if isinstance(frame, int):
+            return frame
+        name, pos = frame
+        if msg_type in (b'j', b'M', b'd'):
+            msg = name
+        elif msg_type == b'n':
+            msg = [name, view[pos], view[pos + 1]]
+        else:
+            msg = [name, bytes(view[pos:pos + 1]).decode("ascii")]
+        return (msg_type, msg, pos + tail)
+
+    if msg_type == b's':
+        if end - pos < 1:
+            return 1
+        return (msg_type, bytes(view[pos:pos + 1]).decode("ascii"), pos + 1)
+
+    if msg_type == b'k':
+        if end - pos < 2:
+            return 2 - (end - pos)
+        return (msg_type, [view[pos], view[pos + 1]], pos + 2)
+
+    if msg_type == b'w':
+        if end - pos < MAZE_LEN:
+            return MAZE_LEN - (end - pos)
+        msg = bytes(view[pos:pos + MAZE_LEN]).decode("ascii")
+        return (msg_type, msg, pos + MAZE_LEN)
+
+    if msg_type == b'v':  # agreed version and player id
+        if end - pos < 1:
+            return 1
+        frame = _parse_varints(view, pos + 1, end, 1, 0)
+        if isinstance(frame, int):
+            return frame
+        (player_id,), next_pos = frame
+        return (msg_type, [view[pos], player_id], next_pos)
+
+    if msg_type == b'p':  # move by player id
+        frame = _parse_varints(view, pos, end, 1, 1)
+        if isinstance(frame, int):
+            return frame
+        (player_id,), pos = frame
+        return (msg_type, [player_id, view[pos]], pos + 1)
+
+    if msg_type in (b'x', b'K'):
+        count = 1 if msg_type == b'x' else 2
+        frame = _parse_varints(view, pos, end, count, 0)
+        if isinstance(frame, int):
+            return frame
+        values, pos = frame
+        return (msg_type, values[0] if count == 1 else values, pos)
+
+    if msg_type == b'i':  # new player with id
+        frame = _parse_varints(view, pos, end, 1, 1)
+        if isinstance(frame, int):
+            return frame
+        (player_id,), pos = frame
+        frame = _parse_named(view, pos, end, 2)
+        if isinstance(frame, int):
+            return frame
+        name, pos = frame
+        frame = _parse_varints(view, pos, end, 2, 0)
+        if isinstance(frame, int):
+            return frame
+        (y, x), pos = frame
+        return (msg_type, [name, player_id, y, x], pos)
+
+    if msg_type == b'D':  # tick delta
+        return _parse_delta(view, pos, end)
+
+    if msg_type == b'b':  # compact board
+        return _parse_board(view, pos, end)
+
+    if msg_type == b'R':  # world region, its position and a board
+        frame = _parse_varints(view, pos, end, 2, 0)
+        if isinstance(frame, int):
+            return frame
+        (y, x), pos = frame
+        frame = _parse_board(view, pos, end)
+        if isinstance(frame, int):
+            return frame
+        _, board, pos = frame
+        return (msg_type, [board, y, x], pos)
+
+    raise ProtocolError("unknown message type %r" % msg_type)
+
+
+def _parse_board(view, pos, end):
+    """
+    Parse a board header and payload.
+
+    returns:
+        (b'b', maze.Board, next_pos), or the number of bytes still missing
+    """
+    if end - pos < BOARD_HEADER.size:
+        return BOARD_HEADER.size - (end - pos)
+    flags, rows, cols, size = BOARD_HEADER.unpack_from(view, pos)
+    pos += BOARD_HEADER.size
+    expected = ((rows + 1) * cols + rows * (cols + 1) + 7) // 8
+    # zlib adds a few bytes to data it can not compress
+    if expected > MAX_BOARD_BYTES or size > expected + 64:
+        raise ProtocolError("board of %dx%d in %d bytes"
+                            % (rows, cols, size))
+    if end - pos < size:
+        return size - (end - pos)
+    payload = bytes(view[pos:pos + size])
+    try:
+        if flags & BOARD_ZLIB:
+            payload = zlib.decompressobj().decompress(payload, expected)
+        if len(payload) != expected:
+            raise ValueError("board payload of %d bytes" % len(payload))
+        board = maze.Board.unpack(payload, rows, cols)
+    except (ValueError, zlib.error) as exc:
+        raise ProtocolError("bad board: %s" % exc) from exc
+    return (b'b', board, pos + size)
+
+
+def _parse_delta(view, pos, end):
+    """
+    Parse the body of a tick delta message.
+
+    returns:
+        (b'D', [leaves, joins, moves, keys], next_pos), or the number of
+        bytes still missing
+    """
+    sections = []
+    for section in range(4):
+        frame = _parse_varints(view, pos, end, 1, 0)
+        if isinstance(frame, int):
+            return frame
+        (count,), pos = frame
+        entries = []
+        for _ in range(count):
+            if section == 0:  # leaves, an id each
+                frame = _parse_varints(view, pos, end, 1, 0)
+            elif section == 1:  # joins, id, name, y and x
+                frame = _parse_varints(view, pos, end, 1, 1)
+                if isinstance(frame, int):
+                    return frame
+                (player_id,), pos = frame
+                frame = _parse_named(view, pos, end, 2)
+                if isinstance(frame, int):
+                    return frame
+                name, pos = frame
+                frame = _parse_varints(view, pos, end, 2, 0)
+                if not isinstance(frame, int):
+                    frame = ([player_id, name] + frame[0], frame[1])
+            elif section == 2:  # moves, id, y and x
+                frame = _parse_varints(view, pos, end, 3, 0)
+            else:  # keys, y, x and whether the key is there
+                frame = _parse_varints(view, pos, end, 2, 1)
+                if not isinstance(frame, int):
+                    frame = (frame[0] + [view[frame[1]]], frame[1] + 1)
+            if isinstance(frame, int):
+                return frame
+            values, pos = frame
+            entries.append(values[0] if section == 0 else values)
+        sections.append(entries)
+    return (b'D', sections, pos)
+
+
+def _parse_named(view, pos, end, tail):
+    """
+    Parse a length prefixed utf-8 string followed by tail more bytes.
+
+    returns:
+        (string, pos of the tail), or the number of bytes still missing
+    """
+    if end - pos < 1:
+        return 1
+    name_len = view[pos]
+    pos += 1
+    if end - pos < name_len + tail:
+        return name_len + tail - (end - pos)
+    return (bytes(view[pos:pos + name_len]).decode("utf-8"), pos + name_len)
+
+
+def _parse_varints(view, pos, end, count, tail):
+    """
+    Parse count varints followed by tail more bytes.
+
+    returns:
+        (list of ints, pos after the varints), or the number of bytes
+        still missing
+    """
+    values = []
+    for _ in range(count):
+        value = 0
+        shift = 0
+        while True:
+            if shift == 7 * MAX_VARINT_BYTES:
+                raise ProtocolError("varint longer than %d bytes"
+                                    % MAX_VARINT_BYTES)
+            if pos >= end:
+                return 1 + tail
+            byte = view[pos]
+            pos += 1
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        values.append(value)
+    if end - pos < tail:
+        return tail - (end - pos)
+    return (values, pos)
 
 
 def _receive_type(sckt):
@@ -1,28 +1,87 @@
 import random
 import maze
 import numpy as np
+from paths import MazeGraph, DistanceOracle
+from world import ChunkedWorld
 import logging
-from copy import deepcopy
 
 
 class Game():
     def __init__(self):
         self.players = {}
-        self.keys = []
+        self.keys = {}  # position -> Key
+        self.occupied = {}  # position -> name of the player standing there
         self.rows = 15
         self.cols = 21
         self.num_keys = 20
         self.keys_spawned = False
         self.board = None
-
-    def genboard(self):
-        """generate a game board"""
-        maze_str = maze.make_maze(self.cols, self.rows)
-        board = maze.read_maze(maze_str)
-        self.board = board
+        self.seed = None
+        self.algorithm = None
+        self.graph = None
+        self.oracle = None
+        self.world = None  # a ChunkedWorld replaces the board in world mode
+        self.origin = (0, 0)  # position of the board's first cell
+
+    def genboard(self, seed=None, algorithm='backtracker'):
+        """generate a game board, the same seed always gives the same
+        board"""
+        if seed is None:
+            seed = random.getrandbits(64)
+        self.seed = seed
+        self.algorithm = algorithm
+        self.board = maze.generate(self.rows, self.cols, seed, algorithm)
+        self.origin = (0, 0)
+        self.graph = None
+        self.oracle = None
+
+    def genworld(self, rows, cols, seed=None, chunk_size=64):
+        """make this game a chunked world of rows x cols cells, which is
+        only generated where players and keys are"""
+        self.world = ChunkedWorld(rows, cols, seed, chunk_size)
+        self.seed = self.world.seed
+        self.rows, self.cols = rows, cols
+        self.board = None
+        self.graph = None
+        self.oracle = None
 
     def loadboard(self, strinp):
-        self.board = maze.read_maze(strinp)
+        self.setboard(maze.read_maze(strinp))
+
+    def setboard(self, board, origin=(0, 0)):
+        """use an existing maze.Board. With an origin the board is only
+        the part of a world starting at that position, and walls outside
+        it are unknown"""
+        self.board = board
+        self.origin = origin
+        self.rows, self.cols = board.rows, board.cols
+        self.graph = None
+        self.oracle = None
+
+    def maze_graph(self):
+        """The passages of the current board, built on first use. Raises
+        ValueError in world mode, the world is never whole"""
+        if self.world is not None:
+            raise ValueError("distances through the maze are not "
+                             "available in world mode")
+        if self.graph is None:
+            self.graph = MazeGraph(self.board)
+        return self.graph
+
+    def maze_oracle(self):
+        """The distance oracle of the current board, built on first use.
+        Raises ValueError if the board is not a perfect maze"""
+        if self.oracle is None:
+            self.oracle = DistanceOracle(self.maze_graph())
+        return self.oracle
+
+    def distance(self, a, b):
+        """Number of steps through the maze between positions a and b"""
+        return self.maze_oracle().distance(a, b)
+
+    def path(self, a, b):
+        """The positions on the way from a to b, both included"""
+        return self.maze_oracle().path(a, b)
 
     def new_player(self, name):
         """generate a new player position"""
@@ -40,43 +99,46 @@ class Game():
 
     def add_player(self, name, y, x):
         """add a player from existing coordinates"""
+        if name in self.players:
+            self._vacate(self.players[name])
         self.players[name] = player(name, (y, x))
+        self.occupied[(y, x)] = name
+        if self.world is not None:
+            self.world.touch(y, x)
 
     def delete_player(self, name):
-        del self.players[name]
+        self._vacate(self.players.pop(name))
+        if self.world is not None:
+            self.world.evict(self.occupied)
 
-    def find_furthest(self, y, x):
-        vis = [[0] * self.cols + [1] for _ in range(self.rows)] + [[1] * (self.cols + 1)]
+    def _vacate(self, plyr):
+        """Remove a player from the occupancy index"""
+        if self.occupied.get(plyr.pos) == plyr.name:
+            del self.occupied[plyr.pos]
 
-        def walk(y, x):
-            vis[y][x] = 1
-            bestSolution = {"start": (y, x), "end": (y, x), "distance": 0}
-            d = [(y, x - 1), (y + 1, x), (y, x + 1), (y - 1, x)]
-            random.shuffle(d)
-            for (yy, xx) in d:
-                if vis[yy][xx]:
-                    continue
+    def player_at(self, y, x):
+        """The name of the player at (y, x), or None"""
+        return self.occupied.get((y, x))
 
-                newbest = walk(yy, xx)
-                if newbest["distance"] > bestSolution["distance"]:
-                    bestSolution["distance"] = newbest["distance"] + 1
-                    bestSolution["end"] = newbest["end"]
-            return bestSolution
-
-        return walk(y, x)
+    def find_furthest(self, y, x):
+        """Find a cell as far as possible from (y, x) through the maze"""
+        cells, distance = self.maze_graph().furthest([(y, x)])
+        return {"start": (y, x), "end": random.choice(cells),
+                "distance": distance}
 
     def get_common_furthest(self):
         """Get a point that is quite far from players and keys"""
-        dist_grid = np.ones((self.rows, self.cols))
-        for player_name in self.players:
-            y, x = self.players[player_name].pos
-            grid = self.distance_grid(y, x)
-            dist_grid = dist_grid * grid
-
-        for key in self.keys:
-            y, x = key.pos
-            grid = self.distance_grid(y, x)
-            dist_grid = dist_grid * grid
+        if self.world is not None:
+            return self._world_spot()
+        # the sum of log distances ranks cells like their product would,
+        # without overflowing once there are a few hundred players
+        dist_grid = np.zeros((self.rows, self.cols))
+        taken = [plyr.pos for plyr in self.players.values()]
+        taken += [key.pos for key in self.keys.values()]
+        with np.errstate(divide='ignore'):
+            for y, x in taken:
+                grid = self.distance_grid(y, x)
+                dist_grid += np.log(np.maximum(grid, 0))
 
         result = np.where(dist_grid == np.amax(dist_grid))
         listOfCordinates = list(zip(result[0], result[1]))
@@ -87,61 +149,75 @@ class Game():
 
         return (y, x)
 
+    def _world_spot(self, tries=16):
+        """A free cell of the world far from players and keys, the best of
+        a few random cells by straight line distance"""
+        taken = list(self.occupied) + list(self.keys)
+        best, best_dist = None, -1
+        for _ in range(tries):
+            y = random.randrange(self.rows)
+            x = random.randrange(self.cols)
+            dist = min((abs(y - ty) + abs(x - tx) for ty, tx in taken),
+                       default=0)
+            if dist > best_dist:
+                best, best_dist = (y, x), dist
+        self.world.touch(*best)
+        return best
+
     def distance_grid(self, y, x):
-        """return a 2d numpy array containing distance from (y, x)"""
-        grid = np.zeros((self.rows, self.cols))
-        vis = [[0] * self.cols + [1] for _ in range(self.rows)] + [[1] * (self.cols + 1)]
-
-        def walk(y, x, dist):
-            vis[y][x] = 1
-            grid[y][x] = dist
-            d = [(y, x - 1), (y + 1, x), (y, x + 1), (y - 1, x)]
-            random.shuffle(d)
-            for (yy, xx) in d:
-                if vis[yy][xx]:
-                    continue
-                walk(yy, xx, dist+1)
-
-        walk(y, x, 0)
-        return grid
+        """return a 2d numpy array containing the distance through the maze
+        from (y, x), -1 where it can not be reached"""
+        return self.maze_graph().distance_grid([(y, x)])
 
     def move(self, name, direction):
         """Attempt to move a player in a direction, returns True if
         legal move, else false"""
         plyr = self.players[name]
-        newy, newx = deepcopy(plyr.pos)
-        chky = 0
-        chkx = 0
-        if direction == 0:
-            newy -= 1
-        elif direction == 1:
-            newx += 1
-            chky = 1
-            chkx = 1
-        elif direction == 2:
-            newy += 1
-            chky = 2
-        elif direction == 3:
-            newx -= 1
-            chky = 1
+        y, x = plyr.pos
+        if direction not in (0, 1, 2, 3):
+            return False
+        newy, newx = step(y, x, direction)
 
         # Move player
-        y, x = plyr.pos
-        wally = y * 2
-        if self.board[wally + chky][x + chkx] == 0:  # check no wall
-            for check_player in self.players.values():
-                if check_player.pos == (newy, newx):
-                    return False
+        if not self.wall(y, x, direction):  # check no wall
+            if (newy, newx) in self.occupied:
+                return False
+            self._vacate(plyr)
             plyr.pos = (newy, newx)
+            self.occupied[plyr.pos] = name
+            if self.world is not None:
+                self._crossed(y, x, newy, newx)
             return True
 
         return False  # illegal move
 
+    def wall(self, y, x, direction):
+        """True if cell (y, x) has a wall on side direction, NESW as 0-3"""
+        if self.world is not None:
+            return self.world.wall(y, x, direction)
+        y -= self.origin[0]
+        x -= self.origin[1]
+        if not (0 <= y < self.rows and 0 <= x < self.cols):
+            return False  # off the known part, the server decides
+        if direction == 0:
+            return self.board.hor[y, x]
+        if direction == 1:
+            return self.board.ver[y, x + 1]
+        if direction == 2:
+            return self.board.hor[y + 1, x]
+        return self.board.ver[y, x]
+
+    def _crossed(self, y, x, newy, newx):
+        """Drop the chunks nobody is near once a player leaves a chunk"""
+        size = self.world.chunk_size
+        if (y // size, x // size) != (newy // size, newx // size):
+            self.world.evict(self.occupied)
+
     def spawn_keys(self):
         if not self.keys_spawned:
             for _ in range(self.num_keys):
                 y, x = self.get_common_furthest()
-                self.keys.append(Key((y, x)))
+                self.keys[(y, x)] = Key((y, x))
             self.keys_spawned = True
             return True
         return False
@@ -149,23 +225,24 @@ class Game():
     def toggle_key(self, y, x):
         """Toggle a key, returns False if key was deleted, True if new key
         added"""
-        for key in self.keys:
-            keyy, keyx = key.pos
-            if (keyy == y) and (keyx == x):
-                self.keys.remove(key)  # Delete key
-                return False
-        self.keys.append(Key((y, x)))  # Create new key
+        if (y, x) in self.keys:
+            del self.keys[(y, x)]  # Delete key
+            return False
+        self.keys[(y, x)] = Key((y, x))  # Create new key
         return True
 
+    def set_key(self, y, x, present):
+        """Add or remove the key at (y, x)"""
+        if present != ((y, x) in self.keys):
+            self.toggle_key(y, x)
+
     def check_key(self, name):
         """check if player name is standing on a key, if so remove the key
         and return the keys position, else return None"""
-        y, x = self.players[name].pos
-        for key in self.keys:
-            keyy, keyx = key.pos
-            if (keyy == y) and (keyx == x):
-                self.keys.remove(key)  # Delete key
-                return (keyy, keyx)
+        pos = self.players[name].pos
+        if pos in self.keys:
+            del self.keys[pos]  # Delete key
+            return pos
         return None
 
     def is_win(self):
@@ -178,13 +255,11 @@ class Game():
         pass
 
     def mazestr(self):
-        """A function that creates a string of the maze"""
-        try:
-            maze_string = maze.draw_maze(self.board)
-        except TypeError as e:
-            print(self.board)
-            raise e
-        return maze_string
+        """The ascii form of the maze, rendered once per board. Raises
+        ValueError in world mode, see ChunkedWorld.region"""
+        if self.world is not None:
+            raise ValueError("a world is too big to draw whole")
+        return maze.draw_maze(self.board)
 
 
 class player():
@@ -210,3 +285,14 @@ class player():
 class Key():
     def __init__(self, pos):
         self.pos = pos
+
+
+def step(y, x, direction):
+    """The cell next to (y, x) in direction, NESW as 0-3"""
+    if direction == 0:
+        return (y - 1, x)
+    if direction == 1:
+        return (y, x + 1)
+    if direction == 2:
+        return (y + 1, x)
+    return (y, x - 1)
@@ -0,0 +1,224 @@
+"""
+The handoff module lets a new server process take over a running game
+without dropping anyone. A server started with --handoff PATH waits for a
+successor on the unix socket at PATH; a server started later with the same
+option connects to it first, and the old server hands over the game and
+its sockets and exits:
+
+    python server.py --handoff /tmp/maze.sock        # running
+    python server.py --handoff /tmp/maze.sock        # new build, takes over
+
+The listening sockets and every client connection are passed as file
+descriptors (SCM_RIGHTS), so clients stay connected and only notice a short
+pause. The game goes along as plain data: the board or world, players, keys,
+and for each client its name, protocol version, world page, unsent frames
+and unparsed input.
+
+On the handoff socket the old server sends chunks of descriptors, each with
+a 4 byte count, a count of 0 ending them, then the state as json with an 8
+byte length, bytes in it as base64. The socket is only open to its owner,
+and both ends hang up on a peer running as another user.
+
+Authors: Tomass Wilson
+"""
+import base64
+import json
+import logging
+import os
+import socket
+import struct
+import maze
+from game_logic import Game
+
+MAX_FDS = 250  # descriptors per message, Linux allows 253
+TIMEOUT = 10  # seconds the handoff may take
+
+
+def listening_socket(path):
+    """Listen for a successor on the unix socket at path"""
+    if os.path.exists(path):
+        os.unlink(path)  # left over by a server that died
+    sckt = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sckt.setblocking(0)
+    umask = os.umask(0o177)  # created 0600, connecting needs write access
+    try:
+        sckt.bind(path)
+    finally:
+        os.umask(umask)
+    sckt.listen(1)
+    return sckt
+
+
+def same_user(conn):
+    """True if the process at the other end of the unix socket conn runs
+    as the same user as this one"""
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                            struct.calcsize('3i'))
+    _, uid, _ = struct.unpack('3i', creds)
+    return uid == os.getuid()
+
+
+def hand_over(server):
+    """Send the game and all sockets of server to the process connecting
+    to its handoff socket. Returns False if nobody was connecting"""
+    try:
+        conn, _ = server.handoff.accept()
+    except (BlockingIOError, InterruptedError):
+        return False
+    if not same_user(conn):
+        logging.warning('refused a handoff to a process of another user')
+        conn.close()
+        return False
+    path = server.handoff.getsockname()
+    server.selector.unregister(server.handoff)
+    server.handoff.close()
+    os.unlink(path)  # the successor listens there next
+    server.handoff = None
+    for csocket in server.admin_conns:
+        server.selector.unregister(csocket)
+        csocket.close()
+    server.admin_conns.clear()
+
+    state, socks = snapshot(server)
+    conn.setblocking(True)
+    conn.settimeout(TIMEOUT)
+    with conn:
+        fds = [sckt.fileno() for sckt in socks]
+        for start in range(0, len(fds), MAX_FDS):
+            chunk = fds[start:start + MAX_FDS]
+            socket.send_fds(conn, [struct.pack('!I', len(chunk))], chunk)
+        conn.sendall(struct.pack('!I', 0))
+        data = json.dumps(state).encode('ascii')
+        conn.sendall(struct.pack('!Q', len(data)) + data)
+        conn.recv(1)  # the successor has everything once this returns
+    logging.info('handed over %d clients', len(state['clients']))
+    return True
+
+
+def snapshot(server):
+    """The state of server as plain data, and the sockets it refers to
+    by index"""
+    socks = []
+
+    def index(sckt):
+        if sckt is None:
+            return None
+        socks.append(sckt)
+        return len(socks) - 1
+
+    game = server.game
+    clients = []
+    for sckt, outbox in server.outboxes.items():
+        name = server.client_names.get(sckt)
+        clients.append({
+            'sock': index(sckt),
+            'name': name,
+            'id': server.player_ids.get(name),
+            'version': server.versions.get(sckt, 1),
+            'pos': game.players[name].pos if name is not None else None,
+            'page': server.pages.get(sckt),
+            'outbox': _b64(b''.join(bytes(frame) for frame in outbox)),
+            'input': _b64(server.decoders[sckt].pending()),
+        })
+    world = game.world
+    state = {
+        'hor': game.board.hor.tolist() if world is None else None,
+        'ver': game.board.ver.tolist() if world is None else None,
+        'world': None if world is None else (world.rows, world.cols,
+                                             world.chunk_size),
+        'seed': game.seed,
+        'algorithm': game.algorithm,
+        'keys': list(game.keys),
+        'keys_spawned': game.keys_spawned,
+        'next_id': server.next_id,
+        'win': server.win,
+        'listener': index(server.sckt),
+        'admin': index(server.admin),
+        'clients': clients,
+    }
+    return state, socks
+
+
+def take_over(path):
+    """Take the game from the server waiting at path. Returns the state
+    and the sockets, or None if no server is waiting there. Raises
+    PermissionError if the server there runs as another user"""
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        conn.close()
+        return None
+    if not same_user(conn):
+        conn.close()
+        raise PermissionError("the server at %s runs as another user"
+                              % path)
+    conn.settimeout(TIMEOUT)
+    with conn:
+        socks = []
+        while True:
+            data, fds, _, _ = socket.recv_fds(conn, 4, MAX_FDS)
+            count, = struct.unpack('!I', _recv_exactly(conn, 4, data))
+            if count == 0:
+                break
+            socks.extend(socket.socket(fileno=fd) for fd in fds)
+        size, = struct.unpack('!Q', _recv_exactly(conn, 8))
+        state = json.loads(_recv_exactly(conn, size))
+        conn.sendall(b'.')
+    logging.info('took over %d clients', len(state['clients']))
+    return state, socks
+
+
+def restore(server, state, socks):
+    """Continue the game of state in a new server made without a
+    listening socket"""
+    game = Game()
+    if state['world'] is not None:
+        rows, cols, chunk_size = state['world']
+        game.genworld(rows, cols, state['seed'], chunk_size)
+    else:
+        game.setboard(maze.Board(state['hor'], state['ver']))
+    game.seed = state['seed']
+    game.algorithm = state['algorithm']
+    for y, x in state['keys']:
+        game.toggle_key(y, x)
+    game.keys_spawned = state['keys_spawned']
+    server.game = game
+    server.next_id = state['next_id']
+    server.win = state['win']
+    if state['listener'] is not None:
+        server.sckt = socks[state['listener']]
+        server.sckt.setblocking(0)
+    if state['admin'] is not None:
+        server.admin = socks[state['admin']]
+        server.admin.setblocking(0)
+    for client in state['clients']:
+        sckt = socks[client['sock']]
+        server.adopt(sckt, client['name'])
+        name = client['name']
+        if name is not None:
+            server.client_names[sckt] = name
+            server.player_ids[name] = client['id']
+            if client['version'] >= 2:
+                server.versions[sckt] = client['version']
+            game.add_player(name, *client['pos'])
+        if client['page'] is not None:
+            server.pages[sckt] = tuple(client['page'])
+        server.decoders[sckt].feed(base64.b64decode(client['input']))
+        outbox = base64.b64decode(client['outbox'])
+        if outbox:
+            server.outboxes[sckt].append(outbox)
+            server.wake(sckt)
+
+
+def _b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def _recv_exactly(conn, size, data=b''):
+    while len(data) < size:
+        more = conn.recv(size - len(data))
+        if not more:
+            raise ConnectionResetError('handoff connection broken')
+        data += more
+    return data
@@ -0,0 +1,236 @@
+"""
+The journal module records every change to a game in an append-only
+binary file, so a crashed room can be recovered and a game replayed later.
+
+The file starts with MAGIC and is followed by records of a type byte and
+their fields, numbers being varints as in the protocol:
+    S: board, rows, cols, seed, algorithm as a length prefixed string,
+       world:<chunk size> for a chunked world
+    J: join, player id, y, x, name as a length prefixed utf-8 string
+    M: move, player id, direction as a single byte
+    K: key added or removed, y, x
+    L: leave, player id
+    W: the game was won
+
+Records are collected in memory and written together on commit, with an
+fsync at most every sync_interval seconds.
+
+Usage of the replay tool:
+    python journal.py FILE [--events N | --offset BYTES]
+
+Authors: Tomass Wilson
+"""
+import argparse
+import mmap
+import os
+import time
+from comms import varint
+from game_logic import Game
+
+MAGIC = b'MZJ1'
+
+
+class Journal():
+    """Appends game events to a journal file. An existing journal is
+    replayed first, available as recovered, and a torn last record left
+    by a crash is cut off."""
+
+    def __init__(self, path, sync_interval=0.1):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.recovered = None
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self.recovered = Replay(path).run()
+            with open(path, 'r+b') as journal:
+                journal.truncate(self.recovered.offset)
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                          0o644)
+        self.buf = bytearray()
+        if self.recovered is None:
+            self.buf += MAGIC
+        self.synced = time.monotonic()
+
+    def board(self, game):
+        if game.world is not None:
+            algorithm = b'world:%d' % game.world.chunk_size
+        else:
+            algorithm = game.algorithm.encode('ascii')
+        self.buf += b'S' + varint(game.rows) + varint(game.cols) \
+            + varint(game.seed) + bytes([len(algorithm)]) + algorithm
+
+    def join(self, player_id, name, y, x):
+        name = name.encode('utf-8')
+        self.buf += b'J' + varint(player_id) + varint(y) + varint(x) \
+            + bytes([len(name)]) + name
+
+    def move(self, player_id, direction):
+        self.buf += b'M' + varint(player_id) + bytes([direction])
+
+    def key(self, y, x):
+        self.buf += b'K' + varint(y) + varint(x)
+
+    def leave(self, player_id):
+        self.buf += b'L' + varint(player_id)
+
+    def won(self):
+        self.buf += b'W'
+
+    def commit(self):
+        """Write every record since the last commit with one system call"""
+        if self.buf:
+            os.write(self.fd, self.buf)
+            self.buf.clear()
+            if time.monotonic() - self.synced >= self.sync_interval:
+                os.fsync(self.fd)
+                self.synced = time.monotonic()
+
+    def close(self):
+        self.commit()
+        os.fsync(self.fd)
+        os.close(self.fd)
+
+
+class Replay():
+    """Rebuilds the game from a journal, read through a memory map"""
+
+    def __init__(self, path):
+        self.path = path
+        self.game = None
+        self.names = {}  # player id -> name
+        self.next_id = 0
+        self.won = False
+        self.events = 0  # records replayed
+        self.offset = 0  # end of the last complete record
+
+    def run(self, events=None, offset=None):
+        """Replay the whole journal, or only its first events records or
+        the records ending at or before byte offset. Returns self"""
+        with open(self.path, 'rb') as journal:
+            size = os.fstat(journal.fileno()).st_size
+            if size < len(MAGIC):
+                return self
+            with mmap.mmap(journal.fileno(), 0,
+                           access=mmap.ACCESS_READ) as data:
+                if data[:len(MAGIC)] != MAGIC:
+                    raise ValueError('%s is not a journal' % self.path)
+                self.offset = len(MAGIC)
+                end = size if offset is None else min(offset, size)
+                while events is None or self.events < events:
+                    try:
+                        kind, fields, pos = self.read(data, self.offset)
+                    except IndexError:  # torn record at the end
+                        break
+                    if pos > end:
+                        break
+                    self.apply(kind, fields)
+                    self.offset = pos
+                    self.events += 1
+        return self
+
+    @staticmethod
+    def read(data, pos):
+        """Decode the record at pos without applying it, returns its type,
+        its fields and the position after it"""
+        kind = data[pos]
+        pos += 1
+        if kind == ord('S'):
+            rows, pos = _varint(data, pos)
+            cols, pos = _varint(data, pos)
+            seed, pos = _varint(data, pos)
+            algorithm, pos = _string(data, pos)
+            fields = (rows, cols, seed, algorithm)
+        elif kind == ord('J'):
+            player_id, pos = _varint(data, pos)
+            y, pos = _varint(data, pos)
+            x, pos = _varint(data, pos)
+            name, pos = _string(data, pos)
+            fields = (player_id, y, x, name)
+        elif kind == ord('M'):
+            player_id, pos = _varint(data, pos)
+            fields = (player_id, data[pos])
+            pos += 1
+        elif kind == ord('K'):
+            y, pos = _varint(data, pos)
+            x, pos = _varint(data, pos)
+            fields = (y, x)
+        elif kind == ord('L'):
+            player_id, pos = _varint(data, pos)
+            fields = (player_id,)
+        elif kind == ord('W'):
+            fields = ()
+        else:
+            raise ValueError('unknown record %r at %d' % (chr(kind), pos - 1))
+        return kind, fields, pos
+
+    def apply(self, kind, fields):
+        """Apply a record decoded by read to the game"""
+        if kind == ord('S'):
+            rows, cols, seed, algorithm = fields
+            self.game = Game()  # a new game, the last one ended
+            self.game.rows, self.game.cols = rows, cols
+            self.names = {}
+            self.won = False
+            if algorithm.startswith('world:'):
+                self.game.genworld(rows, cols, seed,
+                                   int(algorithm[len('world:'):]))
+            else:
+                self.game.genboard(seed, algorithm)
+        elif kind == ord('J'):
+            player_id, y, x, name = fields
+            self.names[player_id] = name
+            self.next_id = max(self.next_id, player_id + 1)
+            self.game.add_player(name, y, x)
+        elif kind == ord('M'):
+            player_id, direction = fields
+            self.game.move(self.names[player_id], direction)
+        elif kind == ord('K'):
+            self.game.toggle_key(*fields)
+            self.game.keys_spawned = True
+        elif kind == ord('L'):
+            self.game.delete_player(self.names.pop(fields[0]))
+        elif kind == ord('W'):
+            self.won = True
+
+
+def _varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def _string(data, pos):
+    length = data[pos]
+    pos += 1
+    if pos + length > len(data):
+        raise IndexError('string past the end')
+    return data[pos:pos + length].decode('utf-8'), pos + length
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    PARSER.add_argument('journal')
+    PARSER.add_argument('--events', type=int, default=None,
+                        help='replay only this many records')
+    PARSER.add_argument('--offset', type=int, default=None,
+                        help='replay only the records before this byte')
+    ARGS = PARSER.parse_args()
+    START = time.perf_counter()
+    REPLAY = Replay(ARGS.journal).run(ARGS.events, ARGS.offset)
+    SPENT = time.perf_counter() - START
+    print("replayed %d records, %d bytes, in %.3f s"
+          % (REPLAY.events, REPLAY.offset, SPENT))
+    if REPLAY.game is not None:
+        GAME = REPLAY.game
+        print("board %dx%d seed %s, %d keys%s"
+              % (GAME.rows, GAME.cols, GAME.seed, len(GAME.keys),
+                 ", won" if REPLAY.won else ""))
+        for NAME, PLAYER in GAME.players.items():
+            print("  %s at %s" % (NAME, PLAYER.pos))
+        if GAME.world is None:
+            print(GAME.mazestr())
@@ -0,0 +1,311 @@
+"""
+The loadgen module runs headless bots against a game server, to find out
+how many players a machine can serve and to catch slowdowns. Every bot is
+a normal client speaking the protocol from comms over its own connection:
+it joins with a unique name, then moves and chats at the given rates until
+the run is over.
+
+Join latency is measured from sending the join request to receiving the
+board, and move latency from sending a move to the server's answer to it,
+which is the echo of the move or an illegal move status.
+
+Authors: Tomass Wilson
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+from collections import Counter, deque
+import numpy as np
+from comms import Decoder, Msg, PROTOCOL_VERSION
+from game_logic import step
+
+
+class Histogram():
+    """Latency samples in seconds, summarised at the end of a run"""
+
+    BOUNDS = [0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02,
+              0.05, 0.1, 0.2, 0.5, 1, 2, 5]
+
+    def __init__(self):
+        self.samples = []
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def summary(self):
+        """Count, percentiles in milliseconds and bucket counts"""
+        if not self.samples:
+            return {"count": 0}
+        samples = np.array(self.samples) * 1000
+        counts, _ = np.histogram(samples, [0] + [b * 1000 for b in
+                                               self.BOUNDS] + [np.inf])
+        labels = ["<%gms" % (b * 1000) for b in self.BOUNDS] + ["more"]
+        summary = {"count": len(samples), "mean": float(samples.mean()),
+                   "max": float(samples.max())}
+        for pct in (50, 90, 99, 99.9):
+            summary["p%g" % pct] = float(np.percentile(samples, pct))
+        summary["buckets"] = {label: int(count) for label, count
+                              in zip(labels, counts) if count}
+        return summary
+
+
+class Stats():
+    """Everything measured during a run, shared by all bots"""
+
+    def __init__(self):
+        self.joins = Histogram()
+        self.moves = Histogram()
+        self.errors = Counter()
+        self.sent = Counter()  # messages sent by type
+        self.received = Counter()  # messages received by type
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.start = time.monotonic()
+
+    def report(self):
+        """The results of the run as a dict"""
+        elapsed = time.monotonic() - self.start
+        return {
+            "seconds": elapsed,
+            "join_ms": self.joins.summary(),
+            "move_rtt_ms": self.moves.summary(),
+            "errors": dict(self.errors),
+            "sent": {k.decode(): v for k, v in self.sent.items()},
+            "received": {k.decode(): v for k, v in self.received.items()},
+            "messages_per_second": {
+                "sent": sum(self.sent.values()) / elapsed,
+                "received": sum(self.received.values()) / elapsed},
+            "bytes_per_second": {"sent": self.bytes_sent / elapsed,
+                                 "received": self.bytes_received / elapsed},
+        }
+
+
+class Bot():
+    """A single simulated player"""
+
+    def __init__(self, name, stats, version=PROTOCOL_VERSION,
+                 move_rate=5, chat_rate=0, pattern='walk'):
+        self.name = name
+        self.stats = stats
+        self.version = version
+        self.move_rate = move_rate
+        self.chat_rate = chat_rate
+        self.pattern = pattern
+        self.writer = None
+        self.player_id = None
+        self.board = None
+        self.origin = (0, 0)  # position of the board in a world
+        self.pos = None
+        self.moves = deque()  # send times of unanswered moves
+        self.joined = None  # set once the board has arrived
+        self.won = False
+
+    async def run(self, host, port, duration):
+        """Connect, join and play until duration seconds have passed"""
+        try:
+            reader, self.writer = await asyncio.open_connection(host, port)
+        except OSError as exc:
+            self.stats.errors["connect: " + type(exc).__name__] += 1
+            return
+        self.joined = asyncio.Event()
+        tasks = [asyncio.create_task(self.read_loop(reader))]
+        try:
+            sent = time.monotonic()
+            if self.version >= 2:
+                self.send(Msg(b'J', self.name, self.version))
+            else:
+                self.send(Msg(b'j', self.name))
+            await asyncio.wait_for(self.joined.wait(), duration)
+            self.stats.joins.add(time.monotonic() - sent)
+            if self.move_rate:
+                tasks.append(asyncio.create_task(self.move_loop()))
+            if self.chat_rate:
+                tasks.append(asyncio.create_task(self.chat_loop()))
+            await asyncio.wait(tasks, timeout=duration,
+                               return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.TimeoutError:
+            self.stats.errors["join timeout"] += 1
+        except OSError as exc:
+            self.stats.errors["send: " + type(exc).__name__] += 1
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.writer.close()
+
+    def send(self, msg):
+        frame = msg.encode()
+        self.stats.sent[msg.msg_type] += 1
+        self.stats.bytes_sent += len(frame)
+        self.writer.write(frame)
+
+    async def read_loop(self, reader):
+        """Handle messages until the server closes the connection"""
+        decoder = Decoder()
+        while True:
+            try:
+                data = await reader.read(65536)
+            except OSError as exc:
+                self.stats.errors["recv: " + type(exc).__name__] += 1
+                return
+            if not data:
+                if not self.won:
+                    self.stats.errors["closed by server"] += 1
+                return
+            self.stats.bytes_received += len(data)
+            try:
+                frames = decoder.feed(data)
+            except ConnectionResetError:
+                self.stats.errors["protocol error"] += 1
+                return
+            for msg_type, msg in frames:
+                self.stats.received[msg_type] += 1
+                self.handle(msg_type, msg)
+
+    def handle(self, msg_type, msg):
+        """Track the own player and time the answers to moves"""
+        if msg_type == b'v':
+            self.version, self.player_id = msg
+        elif msg_type in (b'b', b'w'):
+            self.board = msg if msg_type == b'b' else None
+            self.joined.set()
+        elif msg_type == b'R':  # a page of a world
+            self.board, self.origin = msg[0], (msg[1], msg[2])
+            self.joined.set()
+        elif msg_type == b'i' and msg[1] == self.player_id:
+            self.pos = (msg[2], msg[3])
+        elif msg_type == b'n' and msg[0] == self.name:
+            self.pos = (msg[1], msg[2])
+        elif msg_type == b'p' and msg[0] == self.player_id:
+            self.answered(msg[1])
+        elif msg_type == b'm' and msg[0] == self.name:
+            self.answered(int(msg[1]))
+        elif msg_type == b'D':
+            for player_id, y, x in msg[2]:
+                if player_id == self.player_id:
+                    self.pos = (y, x)
+        elif msg_type == b's':
+            if msg == "I":
+                self.answered(None)
+            elif msg == "T":
+                self.stats.errors["name taken"] += 1
+            elif msg == "U":
+                self.stats.errors["unsupported version"] += 1
+            elif msg == "W":
+                self.won = True
+
+    def answered(self, direction):
+        """The server answered the oldest move"""
+        if self.moves:
+            self.stats.moves.add(time.monotonic() - self.moves.popleft())
+        else:
+            self.stats.errors["unexpected move answer"] += 1
+        if direction is not None and self.pos is not None:
+            self.pos = step(*self.pos, direction)
+
+    def direction(self):
+        """The next direction to move in, by the bot's pattern"""
+        if self.pattern == 'walk' and self.board is not None \
+                and self.pos is not None:
+            y, x = self.pos[0] - self.origin[0], self.pos[1] - self.origin[1]
+            board = self.board
+            if 0 <= y < board.rows and 0 <= x < board.cols:
+                walls = (board.hor[y, x], board.ver[y, x + 1],
+                         board.hor[y + 1, x], board.ver[y, x])
+                open_sides = [d for d in range(4) if not walls[d]]
+                if open_sides:
+                    return random.choice(open_sides)
+        return random.randrange(4)
+
+    async def move_loop(self):
+        while True:
+            await asyncio.sleep(random.expovariate(self.move_rate))
+            direction = self.direction()
+            self.moves.append(time.monotonic())
+            if self.version >= 3:
+                self.send(Msg(b'p', self.player_id, direction))
+            else:
+                self.send(Msg(b'm', self.name, direction))
+
+    async def chat_loop(self):
+        while True:
+            await asyncio.sleep(random.expovariate(self.chat_rate))
+            self.send(Msg(b'M', self.name + "> hello"))
+
+
+async def run_bots(args, stats):
+    """Start args.bots bots, spread over args.ramp seconds"""
+    tasks = []
+    delay = args.ramp / args.bots if args.bots else 0
+    for num in range(args.bots):
+        bot = Bot("bot%d" % num, stats, args.version, args.move_rate,
+                  args.chat_rate, args.pattern)
+        end = args.ramp + args.duration - num * delay
+        tasks.append(asyncio.create_task(bot.run(args.host, args.port,
+                                                 end)))
+        await asyncio.sleep(delay)
+    await asyncio.gather(*tasks)
+
+
+def raise_fd_limit():
+    """Allow as many open sockets as the system lets this process have"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    PARSER.add_argument('--host', default='localhost')
+    PARSER.add_argument('--port', type=int, default=26000)
+    PARSER.add_argument('--bots', type=int, default=100,
+                        help='number of simulated players')
+    PARSER.add_argument('--duration', type=float, default=30,
+                        help='seconds every bot plays after joining')
+    PARSER.add_argument('--ramp', type=float, default=5,
+                        help='seconds over which the bots connect')
+    PARSER.add_argument('--move-rate', type=float, default=5,
+                        help='moves per second per bot, 0 for none')
+    PARSER.add_argument('--chat-rate', type=float, default=0,
+                        help='chat messages per second per bot')
+    PARSER.add_argument('--pattern', choices=('walk', 'random'),
+                        default='walk', help='walk only moves through '
+                        'open sides, random also into walls')
+    PARSER.add_argument('--version', type=int, default=PROTOCOL_VERSION,
+                        help='protocol version the bots speak')
+    PARSER.add_argument('--serve', metavar='ENGINE',
+                        help='start a local server on this engine for the '
+                        'run')
+    PARSER.add_argument('--json', action='store_true',
+                        help='print the results as json')
+    ARGS = PARSER.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    raise_fd_limit()
+
+    SERVER = None
+    if ARGS.serve:
+        SERVER = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(__file__),
+                                          'server.py'),
+             '--engine', ARGS.serve, '--port', str(ARGS.port)],
+            stderr=subprocess.DEVNULL)
+        time.sleep(1)
+    STATS = Stats()
+    try:
+        asyncio.run(run_bots(ARGS, STATS))
+    finally:
+        if SERVER is not None:
+            SERVER.terminate()
+            SERVER.wait()
+    REPORT = STATS.report()
+    if ARGS.json:
+        print(json.dumps(REPORT, indent=2))
+    else:
+        for section, values in REPORT.items():
+            print("%s: %s" % (section, values))
@@ -0,0 +1,223 @@
+"""
+The lobby module accepts all connections on the game port and shares
+players out over rooms. Every room is its own game with its own maze, run
+by a server in a pool of worker processes so that one busy room can not
+stall the others.
+
+Messages between the lobby and a worker, sent over a multiprocessing pipe:
+    lobby -> worker: ("open", room_id, world), ("client",) followed by the
+                     socket handle, ("close",)
+    worker -> lobby: ("left",), ("won",), ("done", room_id)
+
+Authors: Tomass Wilson
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import selectors
+import socket
+from multiprocessing import reduction
+from server import Server, listening_socket, world_size
+
+
+class Lobby():
+    """Accepts players and assigns them to rooms run by worker processes.
+    With world as (rows, cols) every room is a chunked world"""
+
+    def __init__(self, port=26000, num_workers=None, room_size=8,
+                 world=None):
+        self.sckt = listening_socket(port)
+        self.world = world
+        logging.info('lobby starting up on %s', self.sckt.getsockname())
+        self.room_size = room_size
+        self.selector = selectors.DefaultSelector()
+        self.workers = []
+        self.next_room = 0
+        for _ in range(num_workers or os.cpu_count() or 1):
+            self.start_worker()
+
+    def start_worker(self):
+        """Start a new idle worker process"""
+        worker = Worker()
+        self.workers.append(worker)
+        self.selector.register(worker.conn, selectors.EVENT_READ, worker)
+        return worker
+
+    def listen(self):
+        """Accept players and follow the rooms forever"""
+        self.selector.register(self.sckt, selectors.EVENT_READ)
+        while True:
+            for key, _ in self.selector.select():
+                if key.fileobj is self.sckt:
+                    self.accept()
+                else:
+                    self.read_worker(key.data)
+
+    def accept(self):
+        """Hand every pending connection over to a room"""
+        while True:
+            try:
+                (csocket, address) = self.sckt.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            worker = self.find_room()
+            logging.info('sending %s to room %d', address, worker.room_id)
+            worker.send_client(csocket)
+            csocket.close()
+
+    def find_room(self):
+        """Pick the room for a new player, opening a new one if all open
+        rooms are full. When every worker is busy the least full open room
+        is used even if it is over size."""
+        open_rooms = [worker for worker in self.workers if worker.accepting]
+        for worker in open_rooms:
+            if worker.players < self.room_size:
+                return worker
+        for worker in self.workers:
+            if worker.room_id is None:
+                worker.open_room(self.next_room, self.world)
+                self.next_room += 1
+                return worker
+        if not open_rooms:  # every room is closing, add a worker
+            worker = self.start_worker()
+            worker.open_room(self.next_room, self.world)
+            self.next_room += 1
+            return worker
+        return min(open_rooms, key=lambda worker: worker.players)
+
+    def read_worker(self, worker):
+        """Act on a message from a worker"""
+        try:
+            msg = worker.conn.recv()
+        except EOFError:
+            logging.warning('worker %d died, room %s lost',
+                            worker.process.pid, worker.room_id)
+            self.selector.unregister(worker.conn)
+            self.workers.remove(worker)
+            worker.conn.close()
+            self.start_worker()
+            return
+
+        if msg[0] == 'left':
+            worker.players -= 1
+            if worker.players == 0 and worker.accepting:
+                logging.info('room %d is empty, closing', worker.room_id)
+                worker.close_room()
+        elif msg[0] == 'won':
+            logging.info('room %d has been won, closing', worker.room_id)
+            worker.close_room()
+        elif msg[0] == 'done':
+            logging.info('room %d closed, worker %d free', msg[1],
+                         worker.process.pid)
+            worker.room_id = None
+            worker.players = 0
+
+
+class Worker():
+    """The lobby side of a worker process, and the room it is running"""
+
+    def __init__(self):
+        # spawn, so workers do not inherit the lobby's sockets and pipes
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=run_worker,
+                                       args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.room_id = None
+        self.players = 0
+        self.accepting = False
+
+    def open_room(self, room_id, world=None):
+        self.room_id = room_id
+        self.players = 0
+        self.accepting = True
+        self.conn.send(("open", room_id, world))
+
+    def send_client(self, csocket):
+        self.players += 1
+        self.conn.send(("client",))
+        reduction.send_handle(self.conn, csocket.fileno(), self.process.pid)
+
+    def close_room(self):
+        self.accepting = False
+        self.conn.send(("close",))
+
+
+class RoomServer(Server):
+    """A server for one room, getting its clients from the lobby"""
+
+    def __init__(self, conn, room_id, world=None):
+        Server.__init__(self, port=None, world=world)
+        self.conn = conn
+        self.room_id = room_id
+        self.closing = False
+        self.reported_win = False
+
+    def listen(self):
+        self.selector.register(self.conn, selectors.EVENT_READ)
+        Server.listen(self)
+        for csocket in list(self.outboxes):
+            csocket.close()
+
+    def read(self, readable):
+        if self.conn in readable:
+            readable.remove(self.conn)
+            self.read_lobby()
+        Server.read(self, readable)
+
+    def read_lobby(self):
+        """Act on a message from the lobby"""
+        msg = self.conn.recv()
+        if msg[0] == "client":
+            fd = reduction.recv_handle(self.conn)
+            csocket = socket.socket(fileno=fd)
+            self.adopt(csocket, csocket.getpeername())
+        elif msg[0] == "close":
+            self.closing = True
+
+    def remove_client(self, sckt):
+        Server.remove_client(self, sckt)
+        self.conn.send(("left",))
+
+    def finished(self):
+        """Tell the lobby once the game is won and everyone has been told,
+        but keep serving until the lobby closes the room"""
+        if Server.finished(self) and not self.reported_win:
+            self.reported_win = True
+            self.conn.send(("won",))
+        return self.closing
+
+
+def run_worker(conn):
+    """Run rooms one after another as the lobby asks for them"""
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:  # lobby gone
+            return
+        if msg[0] == "open":
+            room = RoomServer(conn, msg[1], msg[2])
+            room.listen()
+            conn.send(("done", msg[1]))
+        elif msg[0] == "client":  # room already closed, drop the client
+            os.close(reduction.recv_handle(conn))
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    PARSER.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes, one per CPU '
+                             'by default')
+    PARSER.add_argument('--room-size', type=int, default=8,
+                        help='players per room before a new room opens')
+    PARSER.add_argument('--world', metavar='ROWSxCOLS', type=world_size,
+                        default=None, help='make every room a chunked '
+                        'world of this size, multiples of 64. Version 3 '
+                        'clients only')
+    ARGS = PARSER.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    LOBBY = Lobby(num_workers=ARGS.workers, room_size=ARGS.room_size,
+                  world=ARGS.world)
+    LOBBY.listen()
@@ -1,87 +1,319 @@
-import sys
-from random import shuffle, randrange
+"""
+The maze module generates perfect mazes, mazes with exactly one way
+between any two cells, and converts them between Board arrays and their
+ascii form.
 
+All generators are iterative and deterministic for a given seed. They
+carve passages straight into the wall arrays of a Board, where cells are
+numbered row by row, cell (y, x) being y * cols + x.
+"""
+import random
+import numpy as np
 
-def make_maze(w = 15, h = 20):
-    vis = [[0] * w + [1] for _ in range(h)] + [[1] * (w + 1)]
-    ver = [["|  "] * w + ['|'] for _ in range(h)] + [[]]
-    hor = [["+--"] * w + ['+'] for _ in range(h + 1)]
 
-    def walk(x, y):
-        vis[y][x] = 1
+def make_maze(w = 15, h = 20, seed=None, algorithm='backtracker'):
+    """The ascii form of a new w wide and h high maze"""
+    return generate(h, w, seed, algorithm).render()
 
-        d = [(x - 1, y), (x, y + 1), (x + 1, y), (x, y - 1)]
-        shuffle(d)
-        for (xx, yy) in d:
-            if vis[yy][xx]: continue
-            if xx == x: hor[max(y, yy)][x] = "+  "
-            if yy == y: ver[y][max(x, xx)] = "   "
-            walk(xx, yy)
 
-    walk(randrange(w), randrange(h))
+def generate(rows, cols, seed=None, algorithm='backtracker'):
+    """
+    Generate a new maze
 
-    s = ""
-    for (a, b) in zip(hor, ver):
-        s += ''.join(a + ['\n'] + b + ['\n'])
-    return s
+    args:
+        rows, cols: The size of the maze in cells
+        seed: Any value accepted by random.seed, the same seed and
+            algorithm always give the same maze
+        algorithm: One of the names in ALGORITHMS
 
+    returns:
+        A Board
+    """
+    hor = bytearray(b'\x01') * ((rows + 1) * cols)
+    ver = bytearray(b'\x01') * (rows * (cols + 1))
+    ALGORITHMS[algorithm](_Carver(hor, ver, rows, cols), random.Random(seed))
+    return Board(np.frombuffer(hor, dtype=bool).reshape(rows + 1, cols),
+                 np.frombuffer(ver, dtype=bool).reshape(rows, cols + 1))
 
-def read_maze(maze):
-    """Reads a maze string and produces a 2d array of walls"""
-    walls = []
-    for indx, line in enumerate(iter(maze.splitlines())):
-        if indx % 2 == 0:  # even means horizontal, ie skip first char
-            jmp = 1
+
+class _Carver():
+    """Removes walls between neighbouring cells of flat wall arrays"""
+
+    def __init__(self, hor, ver, rows, cols):
+        self.hor = hor
+        self.ver = ver
+        self.rows = rows
+        self.cols = cols
+        self.cells = rows * cols
+
+    def carve(self, a, b):
+        """Open the wall between the neighbouring cells a and b"""
+        if a > b:
+            a, b = b, a
+        if b - a == 1 and b % self.cols:  # same row, not cells above
+            self.ver[b + b // self.cols] = 0  # west wall of b
         else:
-            jmp = 0
-
-        lnwalls = []
-        for char in line:
-            if jmp == 0:
-                jmp = 2
-                if char in ("-", "|"):
-                    lnwalls.append(1)
-                else:
-                    lnwalls.append(0)
-            else:
-                jmp -= 1
-        walls.append(lnwalls)
-
-    return walls
-
-
-def draw_maze(maze_arr):
-    out = ""
-    for indx, line in enumerate(maze_arr):
-        if indx % 2 == 0:
-            out += "+"
-            hor = True
+            self.hor[b] = 0  # north wall of b
+
+    def neighbours(self, cell):
+        """The cells next to cell"""
+        cols = self.cols
+        y, x = divmod(cell, cols)
+        found = []
+        if y > 0:
+            found.append(cell - cols)
+        if x < cols - 1:
+            found.append(cell + 1)
+        if y < self.rows - 1:
+            found.append(cell + cols)
+        if x > 0:
+            found.append(cell - 1)
+        return found
+
+
+def backtracker(carver, rng):
+    """Depth first search with an explicit stack, long winding corridors"""
+    cols, cells = carver.cols, carver.cells
+    hor, ver = carver.hor, carver.ver
+    rand = rng.random
+    visited = bytearray(cells)
+    start = rng.randrange(cells)
+    visited[start] = 1
+    stack = [start]
+    while stack:
+        cell = stack[-1]
+        x = cell % cols
+        options = []
+        if cell >= cols and not visited[cell - cols]:
+            options.append(cell - cols)
+        if x < cols - 1 and not visited[cell + 1]:
+            options.append(cell + 1)
+        if cell + cols < cells and not visited[cell + cols]:
+            options.append(cell + cols)
+        if x > 0 and not visited[cell - 1]:
+            options.append(cell - 1)
+        if not options:
+            stack.pop()
+            continue
+        nxt = options[int(rand() * len(options))]
+        # inlined carver.carve, this loop runs once per cell
+        # with a single column the cells above and below are 1 apart too
+        if nxt == cell + 1 and nxt % cols:
+            ver[nxt + nxt // cols] = 0
+        elif nxt == cell - 1 and cell % cols:
+            ver[cell + cell // cols] = 0
         else:
-            hor = False
-        for wall in line:
-            if wall == 1:
-                if hor:
-                    out += "--+"
-                else:
-                    out += "|  "
-            else:
-                if hor:
-                    out += "  +"
-                else:
-                    out += "   "
-        if not hor:
-            out = out[:-2]
-        out += "\n"
-
-    return out
+            hor[max(cell, nxt)] = 0
+        visited[nxt] = 1
+        stack.append(nxt)
+
+
+def wilson(carver, rng):
+    """Loop erased random walks, every possible maze is equally likely.
+    Slow to start on big mazes, as the first walk has to find a single
+    cell"""
+    in_maze = bytearray(carver.cells)
+    in_maze[rng.randrange(carver.cells)] = 1
+    walk = [0] * carver.cells  # where the walk last left each cell
+    for start in range(carver.cells):
+        cell = start
+        while not in_maze[cell]:
+            options = carver.neighbours(cell)
+            walk[cell] = options[rng.randrange(len(options))]
+            cell = walk[cell]
+        cell = start
+        while not in_maze[cell]:
+            in_maze[cell] = 1
+            carver.carve(cell, walk[cell])
+            cell = walk[cell]
+
+
+def kruskal(carver, rng):
+    """Join cells through the walls in random order, skipping walls
+    between cells that are already connected"""
+    rows, cols = carver.rows, carver.cols
+    walls = np.arange(2 * carver.cells)
+    cells = walls % carver.cells
+    south = (walls < carver.cells) & (cells < carver.cells - cols)
+    east = (walls >= carver.cells) & (cells % cols < cols - 1)
+    walls = walls[south | east]
+    order = np.random.default_rng(rng.getrandbits(64)).permutation(walls)
+
+    parent = list(range(rows * cols))
+    for wall in order.tolist():
+        if wall < carver.cells:
+            first, second = wall, wall + cols
+        else:
+            first = wall - carver.cells
+            second = first + 1
+        a, b = first, second
+        while parent[a] != a:  # find with path halving
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        while parent[b] != b:
+            parent[b] = parent[parent[b]]
+            b = parent[b]
+        if a != b:
+            parent[b] = a
+            carver.carve(first, second)
+
+
+def eller(carver, rng):
+    """
+    Build the maze one row at a time, only ever keeping which cells of the
+    current row are connected. Cost and memory per row are linear in the
+    width, so very large mazes can be streamed.
+    """
+    cols = carver.cols
+    rand = rng.random
+    labels = list(range(cols))
+    next_label = cols
+    for y in range(carver.rows):
+        row = y * cols
+        last = y == carver.rows - 1
+        members = {}
+        for x, label in enumerate(labels):
+            members.setdefault(label, []).append(x)
+
+        # join some neighbours in this row that are not yet connected
+        for x in range(cols - 1):
+            keep, gone = labels[x], labels[x + 1]
+            if keep == gone or not (last or rand() < 0.5):
+                continue
+            carver.carve(row + x, row + x + 1)
+            if len(members[keep]) < len(members[gone]):
+                keep, gone = gone, keep
+            for other in members[gone]:
+                labels[other] = keep
+            members[keep].extend(members.pop(gone))
+        if last:
+            break
+
+        # every set continues down at least once
+        below = [-1] * cols
+        for label, xs in members.items():
+            down = [x for x in xs if rand() < 0.5]
+            if not down:
+                down = [xs[rng.randrange(len(xs))]]
+            for x in down:
+                carver.carve(row + x, row + x + cols)
+                below[x] = label
+        for x in range(cols):
+            if below[x] < 0:
+                below[x] = next_label
+                next_label += 1
+        labels = below
+
+
+def sidewinder(carver, rng):
+    """Runs of east passages, each run with one passage north, all drawn
+    at once with numpy. By far the fastest, but the mazes have a long
+    corridor along the top and are easier to solve going north"""
+    rows, cols, cells = carver.rows, carver.cols, carver.cells
+    gen = np.random.default_rng(rng.getrandbits(64))
+    ver = np.frombuffer(carver.ver, dtype=np.uint8).reshape(rows, cols + 1)
+    hor = np.frombuffer(carver.hor, dtype=np.uint8)
+
+    east = gen.random((rows, cols - 1)) < 0.5
+    east[0] = True  # the top row can not go north, so it is one run
+    ver[:, 1:cols][east] = 0
+
+    starts = np.ones((rows, cols), dtype=bool)
+    starts[:, 1:] = ~east
+    starts = np.flatnonzero(starts)
+    lengths = np.diff(np.append(starts, cells))
+    north = starts + (gen.random(len(starts)) * lengths).astype(np.int64)
+    hor[north[north >= cols]] = 0  # hor index of a north wall is the cell
+
+
+ALGORITHMS = {
+    'backtracker': backtracker,
+    'wilson': wilson,
+    'kruskal': kruskal,
+    'eller': eller,
+    'sidewinder': sidewinder,
+}
+
+
+class Board():
+    """
+    The walls of a maze as two boolean numpy arrays:
+        hor[y, x]: wall on the north side of cell (y, x), row `rows` holds
+                   the south border
+        ver[y, x]: wall on the west side of cell (y, x), column `cols`
+                   holds the east border
+
+    Boards are not changed after they are made, so the ascii form is
+    rendered once and kept.
+    """
+
+    def __init__(self, hor, ver):
+        self.hor = np.asarray(hor, dtype=bool)
+        self.ver = np.asarray(ver, dtype=bool)
+        self.rows, self.cols = self.ver.shape[0], self.hor.shape[1]
+        self._text = None
+
+    @classmethod
+    def from_string(cls, maze):
+        """Read the ascii form of a maze, as made by make_maze or render"""
+        lines = [line for line in maze.splitlines() if line]
+        cols = (len(lines[0]) - 1) // 3
+        width = 3 * cols + 1
+        text = "".join(line.ljust(width)[:width] for line in lines)
+        chars = np.frombuffer(text.encode("ascii"), dtype=np.uint8)
+        chars = chars.reshape(len(lines), width)
+        hor = chars[0::2, 1:width:3] == ord("-")
+        ver = chars[1::2, 0:width:3] == ord("|")
+        return cls(hor, ver)
+
+    def render(self):
+        """The ascii form of the maze, one line per wall row, without a
+        trailing newline"""
+        if self._text is None:
+            width = 3 * self.cols + 1
+            chars = np.full((2 * self.rows + 1, width + 1), ord(" "),
+                            dtype=np.uint8)
+            chars[:, width] = ord("\n")
+            chars[0::2, 0:width:3] = ord("+")
+            walls = np.where(self.hor, ord("-"), ord(" "))
+            chars[0::2, 1:width:3] = walls
+            chars[0::2, 2:width:3] = walls
+            chars[1::2, 0:width:3] = np.where(self.ver, ord("|"), ord(" "))
+            self._text = chars.tobytes()[:-1].decode("ascii")
+        return self._text
+
+    def pack(self):
+        """The walls bit-packed, north walls first"""
+        return np.packbits(np.concatenate([self.hor.ravel(),
+                                           self.ver.ravel()])).tobytes()
+
+    @classmethod
+    def unpack(cls, data, rows, cols):
+        """Make a board of the given size from pack output"""
+        bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8)).astype(bool)
+        split = (rows + 1) * cols
+        hor = bits[:split].reshape(rows + 1, cols)
+        ver = bits[split:split + rows * (cols + 1)].reshape(rows, cols + 1)
+        return cls(hor, ver)
+
+    def __eq__(self, other):
+        return (isinstance(other, Board) and
+                np.array_equal(self.hor, other.hor) and
+                np.array_equal(self.ver, other.ver))
+
+
+def read_maze(maze):
+    """Reads a maze string and produces a Board"""
+    return Board.from_string(maze)
+
+
+def draw_maze(board):
+    """The ascii form of a Board"""
+    return board.render()
 
 
 if __name__ == '__main__':
-    sys.setrecursionlimit(10000)
-    maze = make_maze(21, 15)
-    arr = read_maze(maze)
-    maze2 = draw_maze(arr)
-    print(maze)
-    print(arr)
-    print(maze2)
-    print(len(maze2))
+    for name in ALGORITHMS:
+        board = generate(15, 21, seed=1, algorithm=name)
+        print(name)
+        print(board.render())
@@ -0,0 +1,127 @@
+"""
+The metrics module keeps counters, gauges and histograms for the server
+and writes them in the Prometheus text format, so they can be scraped from
+the server's admin port or read with curl.
+
+Labels are given as a tuple of values, in the order the label names were
+given when the metric was made.
+
+Authors: Tomass Wilson
+"""
+import bisect
+
+# upper bounds in seconds of the default histogram buckets
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01,
+                   0.05, 0.1, 0.5, 1)
+
+
+class Metric():
+    kind = None
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.values = {}  # label values -> value
+
+    def samples(self):
+        """(suffix, label values, value) of every sample"""
+        for key, value in self.values.items():
+            yield "", key, value
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.doc),
+                 "# TYPE %s %s" % (self.name, self.kind)]
+        for suffix, key, value in self.samples():
+            lines.append("%s%s%s %r" % (self.name, suffix,
+                                        _labels(self.labels, key), value))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, key=(), amount=1):
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value read when the metrics are rendered, from a function
+    returning {label values: value}"""
+    kind = "gauge"
+
+    def __init__(self, name, doc, labels=(), func=None):
+        Metric.__init__(self, name, doc, labels)
+        self.func = func
+
+    def samples(self):
+        for key, value in self.func().items():
+            yield "", key, value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+        # only the bucket samples carry the le label
+        Metric.__init__(self, name, doc, labels + ("le",))
+        self.buckets = buckets
+
+    def observe(self, value, key=()):
+        counts = self.values.get(key)
+        if counts is None:
+            # a count per bucket, one for values above all, and the sum
+            counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        for key, counts in self.values.items():
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                total += count
+                yield "_bucket", key + (str(bound),), total
+            yield "_sum", key, counts[-1]
+            yield "_count", key, total
+
+
+class Registry():
+    """All metrics of one server"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, doc, labels=()):
+        return self._add(Counter(name, doc, labels))
+
+    def gauge(self, name, doc, func, labels=()):
+        return self._add(Gauge(name, doc, labels, func))
+
+    def histogram(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, doc, labels, buckets))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Every metric in the Prometheus text format"""
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+def http_response(registry):
+    """A complete HTTP response carrying the rendered metrics"""
+    body = registry.render().encode("utf-8")
+    head = ("HTTP/1.0 200 OK\r\n"
+            "Content-Type: text/plain; version=0.0.4\r\n"
+            "Content-Length: %d\r\n\r\n" % len(body))
+    return head.encode("ascii") + body
+
+
+def _labels(names, values):
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                          .replace('"', '\\"').replace('\n', '\\n'))
+             for name, value in zip(names, values)]
+    if not pairs:
+        return ""
+    return "{" + ",".join(pairs) + "}"
@@ -0,0 +1,169 @@
+"""
+The paths module finds distances through a maze board, following its
+walls. The board is turned into a cell adjacency in CSR form (an index
+pointer array and a neighbour array) once, after which breadth first
+searches from any number of cells are cheap and never recurse.
+
+Cells are numbered row by row, cell (y, x) is number y * cols + x.
+"""
+from collections import deque
+import numpy as np
+
+
+class MazeGraph():
+    """The open passages between neighbouring cells of a board"""
+
+    def __init__(self, board):
+        rows, cols = board.rows, board.cols
+        self.rows = rows
+        self.cols = cols
+
+        cells = np.arange(rows * cols).reshape(rows, cols)
+        south = ~board.hor[1:rows]  # open between (y, x) and (y + 1, x)
+        east = ~board.ver[:, 1:cols]  # open between (y, x) and (y, x + 1)
+        frm = np.concatenate([cells[:-1][south], cells[:, :-1][east]])
+        to = np.concatenate([cells[1:][south], cells[:, 1:][east]])
+        src = np.concatenate([frm, to])
+        dst = np.concatenate([to, frm])
+
+        order = np.argsort(src, kind='stable')
+        indptr = np.zeros(rows * cols + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=rows * cols), out=indptr[1:])
+        self.indptr = indptr
+        self.indices = dst[order]
+        # plain lists are much faster to walk one cell at a time
+        self._indptr = indptr.tolist()
+        self._indices = self.indices.tolist()
+
+    def neighbours(self, cell):
+        """The cells reachable in one step from cell"""
+        return self._indices[self._indptr[cell]:self._indptr[cell + 1]]
+
+    def bfs(self, sources):
+        """
+        Distance from the nearest of several cells to every cell
+
+        args:
+            sources: An iterable of (y, x) positions
+
+        returns:
+            A list indexed by cell number, -1 for unreachable cells
+        """
+        indptr = self._indptr
+        indices = self._indices
+        dist = [-1] * (self.rows * self.cols)
+        todo = deque()
+        for y, x in sources:
+            cell = y * self.cols + x
+            if dist[cell] < 0:
+                dist[cell] = 0
+                todo.append(cell)
+
+        while todo:
+            cell = todo.popleft()
+            step = dist[cell] + 1
+            for k in range(indptr[cell], indptr[cell + 1]):
+                nxt = indices[k]
+                if dist[nxt] < 0:
+                    dist[nxt] = step
+                    todo.append(nxt)
+        return dist
+
+    def distance_grid(self, sources):
+        """bfs, shaped as a (rows, cols) numpy array"""
+        return np.array(self.bfs(sources)).reshape(self.rows, self.cols)
+
+    def furthest(self, sources):
+        """
+        The cells furthest from a set of cells
+
+        returns:
+            (cells, distance) where cells is a list of (y, x) positions
+        """
+        grid = self.distance_grid(sources)
+        distance = grid.max()
+        found = np.argwhere(grid == distance)
+        return [(y.item(), x.item()) for y, x in found], distance.item()
+
+
+class DistanceOracle():
+    """
+    Constant time distances in a perfect maze, one where there is exactly
+    one way between any two cells. Such a maze is a tree, so the distance
+    between two cells follows from the depth of their lowest common
+    ancestor, which is found with a sparse table over the depth first
+    order of the cells.
+    """
+
+    def __init__(self, graph):
+        self.cols = graph.cols
+        cells = graph.rows * graph.cols
+        if len(graph.indices) != 2 * (cells - 1):
+            raise ValueError("board is not a perfect maze")
+
+        parent = [-1] * cells
+        depth = [0] * cells
+        tin = [-1] * cells  # position of each cell in the order
+        order = []
+        stack = [0]
+        while stack:
+            cell = stack.pop()
+            tin[cell] = len(order)
+            order.append(cell)
+            for nxt in graph.neighbours(cell):
+                if tin[nxt] < 0 and nxt != parent[cell]:
+                    parent[nxt] = cell
+                    depth[nxt] = depth[cell] + 1
+                    stack.append(nxt)
+        if len(order) != cells:
+            raise ValueError("board is not a perfect maze")
+        self.parent = parent
+        self.depth = depth
+        self.tin = tin
+
+        # table[k][i] is the shallowest cell of order[i:i + 2**k]
+        depths = np.array(depth, dtype=np.int32)
+        level = np.array(order, dtype=np.int32)
+        self.table = [level]
+        half = 1
+        while 2 * half <= cells:
+            left = level[:-half]
+            right = level[half:]
+            level = np.where(depths[left] <= depths[right], left, right)
+            self.table.append(level)
+            half *= 2
+
+    def ancestor(self, a, b):
+        """The lowest common ancestor of the cells numbered a and b"""
+        if a == b:
+            return a
+        low, high = sorted((self.tin[a], self.tin[b]))
+        low += 1  # the shallowest cell after a is a child of the ancestor
+        k = (high - low + 1).bit_length() - 1
+        left = self.table[k][low]
+        right = self.table[k][high - (1 << k) + 1]
+        if self.depth[right] < self.depth[left]:
+            left = right
+        return self.parent[left]
+
+    def distance(self, a, b):
+        """The number of steps between positions a and b"""
+        a = a[0] * self.cols + a[1]
+        b = b[0] * self.cols + b[1]
+        return (self.depth[a] + self.depth[b]
+                - 2 * self.depth[self.ancestor(a, b)])
+
+    def path(self, a, b):
+        """The list of positions walked from a to b, both included"""
+        a = a[0] * self.cols + a[1]
+        b = b[0] * self.cols + b[1]
+        top = self.ancestor(a, b)
+        up = [a]
+        while up[-1] != top:
+            up.append(self.parent[up[-1]])
+        down = []
+        cell = b
+        while cell != top:
+            down.append(cell)
+            cell = self.parent[cell]
+        return [divmod(cell, self.cols) for cell in up + down[::-1]]
@@ -0,0 +1,147 @@
+"""
+The profiler module samples where a running server spends its time,
+without restarting it. install() makes a signal, SIGUSR2 by default,
+start and stop profiling:
+
+    kill -USR2 <server pid>    # start
+    kill -USR2 <server pid>    # stop and write the results
+
+While profiling, the stack of the main thread is recorded every interval
+seconds of CPU time, and calls to the server's handlers are timed. The
+asyncio engine reads and writes in tasks of their own, so there the
+handling of read frames is timed instead. On stop
+two files are written: the stacks in the collapsed format read by flame
+graph tools, and a table of wall time per handler. Nothing is sampled or
+wrapped while the profiler is off.
+
+Authors: Tomass Wilson
+"""
+import collections
+import logging
+import os
+import signal
+import time
+from async_server import AsyncServer
+
+HANDLERS = ('read', 'write', 'add_player', 'move')
+ASYNC_HANDLERS = ('handle_frames', 'add_player', 'move')
+
+
+class SamplingProfiler():
+    """Profiles a server on demand"""
+
+    def __init__(self, server, out_dir='.', interval=0.005,
+                 handlers=HANDLERS):
+        self.server = server
+        self.out_dir = out_dir
+        self.interval = interval
+        self.handlers = handlers
+        self.running = False
+        self.runs = 0
+        self.stacks = collections.Counter()  # tuple of code objects -> count
+        self.timings = {}  # handler -> [calls, total, max]
+        self.started = None
+
+    def toggle(self, *_):
+        """Start the profiler if it is off, otherwise stop it and write
+        the results. Also the signal handler"""
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def start(self):
+        self.stacks.clear()
+        self.timings = {name: [0, 0.0, 0.0] for name in self.handlers}
+        for name in self.handlers:
+            setattr(self.server, name, self._timed(name))
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.running = True
+        self.started = time.monotonic()
+        logging.info('profiler started')
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        for name in self.handlers:
+            delattr(self.server, name)  # back to the class methods
+        self.running = False
+        self.runs += 1
+        base = os.path.join(self.out_dir, 'profile-%d-%d' % (os.getpid(),
+                                                             self.runs))
+        try:  # in a signal handler, failing here would stop the server
+            with open(base + '.folded', 'w') as out:
+                out.write(self.collapsed())
+            with open(base + '.txt', 'w') as out:
+                out.write(self.table())
+        except OSError as exc:
+            logging.error('profiler stopped, could not write results: %s',
+                          exc)
+            return
+        logging.info('profiler stopped, wrote %s.folded and %s.txt',
+                     base, base)
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            stack.append(frame.f_code)
+            frame = frame.f_back
+        self.stacks[tuple(reversed(stack))] += 1
+
+    def _timed(self, name):
+        """A method of the server that times the original one"""
+        method = getattr(self.server, name)
+        timing = self.timings[name]
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                spent = time.perf_counter() - start
+                timing[0] += 1
+                timing[1] += spent
+                timing[2] = max(timing[2], spent)
+        return timed
+
+    def collapsed(self):
+        """The sampled stacks, one line per stack with the frames from
+        the outermost in, and the number of samples"""
+        lines = []
+        for stack, count in self.stacks.most_common():
+            frames = ('%s (%s:%d)' % (code.co_name,
+                                      os.path.basename(code.co_filename),
+                                      code.co_firstlineno)
+                      for code in stack)
+            lines.append('%s %d\n' % (';'.join(frames), count))
+        return ''.join(lines)
+
+    def table(self):
+        """Calls and wall time of each handler, most total time first"""
+        elapsed = time.monotonic() - self.started
+        lines = ['profiled for %.3f s, %d samples of %g s cpu time\n\n'
+                 % (elapsed, sum(self.stacks.values()), self.interval),
+                 '%-12s %10s %12s %12s %12s %8s\n'
+                 % ('handler', 'calls', 'total s', 'mean us', 'max us',
+                    'wall %')]
+        for name, (calls, total, most) in sorted(
+                self.timings.items(), key=lambda item: -item[1][1]):
+            mean = total / calls if calls else 0
+            lines.append('%-12s %10d %12.6f %12.1f %12.1f %8.2f\n'
+                         % (name, calls, total, mean * 1e6, most * 1e6,
+                            100 * total / elapsed))
+        return ''.join(lines)
+
+
+def install(server, out_dir='.', signum=signal.SIGUSR2, interval=0.005):
+    """Let signum start and stop profiling server. Raises ValueError if
+    out_dir is not a writable directory"""
+    if not os.path.isdir(out_dir) or not os.access(out_dir, os.W_OK):
+        raise ValueError("%r is not a writable directory" % out_dir)
+    handlers = HANDLERS
+    if isinstance(server, AsyncServer):
+        handlers = ASYNC_HANDLERS
+    profiler = SamplingProfiler(server, out_dir, interval, handlers)
+    signal.signal(signum, profiler.toggle)
+    return profiler
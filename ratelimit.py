@@ -0,0 +1,66 @@
+"""
+The ratelimit module holds the token buckets the server uses to limit how
+fast a single client may send each type of message.
+
+Authors: Tomass Wilson
+"""
+import time
+
+# message type -> (messages per second, burst), for every client
+LIMITS = {
+    b'm': (20, 10),  # moves
+    b'p': (20, 10),
+    b'a': (10, 5),  # interactions
+    b'M': (2, 5),  # chat
+    b'j': (1, 3),  # joins, a few retries after a taken name
+    b'J': (1, 3),
+}
+
+
+class TokenBucket():
+    """Allows rate messages per second on average, and up to burst at
+    once after a quiet period"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.dropped = 0
+
+    def take(self):
+        """Use up one token, False if none are left"""
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.dropped += 1
+        return False
+
+
+class RateLimiter():
+    """The token buckets of a single client, one per limited message
+    type, created on first use"""
+
+    def __init__(self, limits=None):
+        self.limits = LIMITS if limits is None else limits
+        self.buckets = {}
+
+    def allow(self, msg_type):
+        """True if the client may send another msg_type message now"""
+        if msg_type not in self.limits:
+            return True
+        bucket = self.buckets.get(msg_type)
+        if bucket is None:
+            bucket = TokenBucket(*self.limits[msg_type])
+            self.buckets[msg_type] = bucket
+        return bucket.take()
+
+    def dropped(self):
+        """The number of dropped messages by type"""
+        return {msg_type: bucket.dropped
+                for msg_type, bucket in self.buckets.items()
+                if bucket.dropped}
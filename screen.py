@@ -1,12 +1,12 @@
 import curses
 import traceback
 import sys
-from time import sleep
+from time import sleep, monotonic
 from game_logic import Game
 
 
 class Screen():
-    def __init__(self, parent, controller):
+    def __init__(self, parent, controller, fps=30):
         self.parent = parent
         self.controller = controller
         self.screen = curses.initscr()
@@ -18,6 +18,10 @@ class Screen():
         self.chat = None
         self.game = None
 
+        self.frame_time = 1 / fps
+        self.last_frame = 0
+        self.dirty = False  # a refresh came too soon and is not drawn yet
+
     def init_colour(self):
         curses.start_color()
         # Player colour
@@ -28,11 +32,36 @@ class Screen():
         curses.init_pair(3, curses.COLOR_YELLOW, curses.COLOR_YELLOW)
 
     def refresh(self):
-        """Refresh all sub screens and main screen"""
+        """Refresh all sub screens and main screen, at most fps times a
+        second. A refresh coming sooner is drawn by draw_due once the
+        frame is due."""
+        if monotonic() - self.last_frame >= self.frame_time:
+            self.draw_frame()
+        else:
+            self.dirty = True
+
+    def timeout(self):
+        """Seconds until a refresh that came too soon is due, or None"""
+        if not self.dirty:
+            return None
+        return max(0, self.last_frame + self.frame_time - monotonic())
+
+    def draw_due(self):
+        """Draw a waiting refresh if its frame is due"""
+        if self.dirty and monotonic() - self.last_frame >= self.frame_time:
+            self.draw_frame()
+
+    def draw_frame(self):
+        """Draw every window and update the terminal once"""
+        self.last_frame = monotonic()
+        self.dirty = False
         if self.game_started:
-            self.chat.refresh()
-            self.game.refresh()
-        self.screen.refresh()
+            self.chat.draw()
+            self.chat.window.noutrefresh()
+            self.game.draw_board()
+            self.game.window.noutrefresh()
+        self.screen.noutrefresh()
+        curses.doupdate()
 
     def welcome(self):
         """Draw a welccome splash screen and get user name"""
@@ -51,6 +80,7 @@ class Screen():
 
     def win(self):
         """draw a win Screen"""
+        self.screen.nodelay(False)
         self.clear()
         self.screen.addstr("Well done! You have found all the keys!\n")
         self.screen.addstr("Press any key to exit\n")
@@ -58,20 +88,40 @@ class Screen():
         curses.endwin()
         sys.exit()
 
-    def start_game(self, maze):
+    def lost(self):
+        """Leave the game after losing the server"""
+        curses.endwin()
+        print("The server closed the connection")
+        sys.exit()
+
+    def start_game(self, maze, origin=(0, 0)):
         """Initialise the game"""
         self.game_started = True
         self.chat = Chat(self, self.controller, 0, 66)
         self.game = GameScreen(self, self.controller, 0, 0)
-        self.game.set_maze(maze)
+        self.game.set_maze(maze, origin)
 
     def clear(self):
         """Clear the entire screen"""
         self.screen.clear()
 
-    def getdir(self):
-        """get a single direction key input"""
-        key = self.screen.getch()
+    def start_input(self):
+        """Read keys without waiting or echoing, for a select loop"""
+        curses.noecho()
+        curses.cbreak()
+        self.screen.nodelay(True)
+
+    def getkeys(self):
+        """All keys pressed since the last call"""
+        keys = []
+        while True:
+            key = self.screen.getch()
+            if key == -1:
+                return keys
+            keys.append(key)
+
+    def getdir(self, key):
+        """The direction of an arrow key, or None"""
         if key == curses.KEY_UP:
             return 0
         if key == curses.KEY_RIGHT:
@@ -104,6 +154,7 @@ class Chat():
         self.window.move(1, 0)
         self.prompt = None
         self.maxlen = None
+        self.line = ""  # chat message being typed
 
     def set_prompt(self, prmpt):
         self.prompt = prmpt
@@ -114,18 +165,30 @@ class Chat():
         self.window.addstr(y, 1, msg + "\n")
         self.refresh()
 
-    def getinp(self):
-        y, x = self.window.getyx()
-        msg = self.window.getstr(y, x, self.maxlen).decode("utf-8")
+    def type_key(self, key):
+        """Add a typed key to the chat message, returns the message once
+        enter is pressed"""
+        if key in (10, 13, curses.KEY_ENTER):
+            line, self.line = self.line, ""
+            self.refresh()
+            return line
+        if key in (8, 127, curses.KEY_BACKSPACE):
+            self.line = self.line[:-1]
+        elif 32 <= key < 127 and len(self.line) < self.maxlen:
+            self.line += chr(key)
         self.refresh()
-        return msg
+        return None
 
     def refresh(self):
+        """Have the chat drawn with the next frame"""
+        self.parent.refresh()
+
+    def draw(self):
         y, x = self.window.getyx()
         if self.prompt is not None:
-            self.window.addstr(y, 1, self.prompt)
+            self.window.addstr(y, 1, self.prompt + self.line)
+            self.window.clrtoeol()
         self.window.border()
-        self.window.refresh()
 
 
 class GameScreen():
@@ -134,32 +197,49 @@ class GameScreen():
         self.controller = controller
         self.window = self.parent.screen.derwin(33, 65, x, y)
         self.game = Game()
+        self.maze_drawn = False
+        self.cells = {}  # position -> (text, colour pair) drawn on the maze
 
     def refresh(self):
-        """Redraw border and refresh screen"""
-        self.draw_board()
-        self.window.refresh()
+        """Have the board drawn with the next frame"""
+        self.parent.refresh()
 
-    def set_maze(self, string):
-        """Take an input string and update the board"""
-        self.game.loadboard(string)
+    def set_maze(self, board, origin=(0, 0)):
+        """Take a maze.Board, starting at origin in the world, and update
+        the board"""
+        self.game.setboard(board, origin)
+        self.maze_drawn = False
 
     def draw_board(self):
-        maze = self.game.mazestr()
-        for num, line in enumerate(maze.splitlines()):
-            self.window.addstr(num, 0, line)
-        for player_name in self.game.players:
-            player = self.game.players[player_name]
-            y, x = player.pos
+        """Draw the maze once, then only the cells whose player or key
+        changed since the last draw"""
+        if not self.maze_drawn:
+            maze = self.game.mazestr()
+            for num, line in enumerate(maze.splitlines()):
+                self.window.addstr(num, 0, line)
+            self.maze_drawn = True
+            self.cells = {}
+        cells = {}
+        for player_name, player in list(self.game.players.items()):
+            # padded, a one letter name must cover a whole cell
             if player_name == self.controller.name:
-                self.draw_cell(y, x, player_name[:2], 1)
+                cells[player.pos] = (player_name[:2].ljust(2), 1)
             else:
-                self.draw_cell(y, x, player_name[:2], 2)
-        for key in self.game.keys:
-            y, x = key.pos
-            self.draw_cell(y, x, "ky", 3)
+                cells[player.pos] = (player_name[:2].ljust(2), 2)
+        for pos in list(self.game.keys):
+            cells[pos] = ("ky", 3)
+        for pos in self.cells.keys() - cells.keys():
+            self.draw_cell(*pos, "  ", 0)  # back to an empty cell
+        for pos, cell in cells.items():
+            if self.cells.get(pos) != cell:
+                self.draw_cell(*pos, *cell)
+        self.cells = cells
 
     def draw_cell(self, y, x, msg, pair_num):
+        y -= self.game.origin[0]
+        x -= self.game.origin[1]
+        if not (0 <= y < self.game.rows and 0 <= x < self.game.cols):
+            return  # on another page of the world
         y = (y*2)+1
         x = (x*3)+1
         self.window.addstr(y, x, msg, curses.color_pair(pair_num))
@@ -3,212 +3,759 @@ The server module owns and runs a server for comunicating between clients
 
 Authors: Tomass Wilson
 """
+import argparse
+import collections
 import socket
-import select
+import selectors
 import logging
-import queue
-import sys
+import os
+import time
 from game_logic import Game
-from comms import receive, Msg
+from comms import Decoder, Msg, send_frames, PROTOCOL_VERSION, \
+    CLIENT_MESSAGES
+from ratelimit import RateLimiter, LIMITS
+from metrics import Registry, http_response
+from journal import Journal
+import handoff
 
+LOG_EVERY = 100  # log one in this many moves, chats and interactions
 
-class Server():
-    """An object that runs a server"""
+VIEW = (15, 21)  # rows and columns of the world a client is sent at once
 
-    def __init__(self):
-        self.sckt = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sckt.setblocking(0)
-        self.port = 26000
-        address = ('', self.port)
-        self.sckt.bind(address)
-        logging.info('starting up on %s port %s',
-                     self.sckt.getsockname(), self.port)
-
-        self.inputs = [self.sckt]
-        self.clients_to_send = []
-
-        self.client_queues = {}
+
+class Server():
+    """An object that runs a server. With port None no listening socket
+    is opened, and clients have to be handed over with adopt. With a tick
+    interval in seconds, state changes for version 3 clients are batched
+    into one delta message per tick. limits maps message types to the
+    (rate, burst) each client is allowed, see ratelimit.LIMITS. With a
+    metrics port, metrics are served over HTTP on localhost. With a
+    journal path, every change to the game is appended to that journal,
+    and a game left unfinished in it is recovered. With world as (rows,
+    cols) the game is a chunked world, open to version 3 clients only,
+    who are sent the page of VIEW cells around their player."""
+
+    def __init__(self, port=26000, tick=None, limits=None,
+                 metrics_port=None, journal=None, world=None):
+        self.port = port
+        self.sckt = None
+        if port is not None:
+            self.sckt = listening_socket(port)
+            logging.info('starting up on %s port %s',
+                         self.sckt.getsockname(), self.port)
+
+        self.selector = selectors.DefaultSelector()
+        self.clients_to_send = set()
+
+        self.outboxes = {}  # encoded frames waiting to be sent
         self.client_names = {}
+        self.versions = {}  # protocol version of clients newer than 1
+        self.player_ids = {}  # name -> compact id, for version 3 clients
+        self.next_id = 0
+        self.decoders = {}
         self.game = Game()
         self.game.genboard()
+        if world is not None:
+            self.game.genworld(*world)
+        self.pages = {}  # origin of the world page each client has
         self.win = False
+        self.tick = tick
+        self.delta = Delta()
+        self.limits = limits
+        self.limiters = {}
+        self.events = collections.Counter()  # for sampled logging
+        self.init_metrics()
+        self.admin = None
+        self.admin_conns = {}  # metrics connection -> answer left to send
+        if metrics_port is not None:
+            self.admin = listening_socket(metrics_port, '127.0.0.1')
+        self.handoff = None
+        self.handed_off = False
+        self.journal = None
+        if journal is not None:
+            self.open_journal(journal)
+
+    def open_journal(self, path, recover=True):
+        """Start journaling to path. With recover the game in it is
+        continued unless it was won, otherwise the current game is
+        written to it in full"""
+        self.journal = Journal(path)
+        replay = self.journal.recovered
+        if not recover or replay is None or replay.game is None \
+                or replay.won:
+            self.journal.board(self.game)
+            for name, plyr in self.game.players.items():
+                self.journal.join(self.player_ids[name], name, *plyr.pos)
+            for y, x in self.game.keys:
+                self.journal.key(y, x)
+        else:
+            logging.info('recovered game from %s, %d keys left', path,
+                         len(replay.game.keys))
+            self.game = replay.game
+            self.next_id = replay.next_id
+            # their connections died with the last server
+            for player_id, name in replay.names.items():
+                self.game.delete_player(name)
+                self.journal.leave(player_id)
+        self.journal.commit()
+
+    def init_metrics(self):
+        """Create the metrics served on the admin port"""
+        self.metrics = Registry()
+        self.messages = self.metrics.counter(
+            'maze_messages_total', 'Messages by direction and type',
+            ('direction', 'type'))
+        self.message_bytes = self.metrics.counter(
+            'maze_message_bytes_total', 'Message bytes by direction and type',
+            ('direction', 'type'))
+        self.dropped = self.metrics.counter(
+            'maze_dropped_messages_total',
+            'Messages dropped for going over the rate limit', ('type',))
+        self.handler_seconds = self.metrics.histogram(
+            'maze_handler_seconds', 'Time spent handling one message',
+            ('type',))
+        self.loop_seconds = self.metrics.histogram(
+            'maze_loop_seconds', 'Time spent on one round of ready events')
+        self.game_seconds = self.metrics.counter(
+            'maze_game_seconds_total', 'Time spent in Game calls', ('call',))
+        self.metrics.gauge('maze_players', 'Players in the game',
+                           lambda: {(): len(self.client_names)})
+        self.metrics.gauge('maze_connections', 'Open client connections',
+                           lambda: {(): len(self.outboxes)})
+        self.metrics.gauge(
+            'maze_outbox_frames',
+            'Frames waiting to be sent, by client connection',
+            lambda: {(self.fileno(sckt),): len(outbox)
+                     for sckt, outbox in self.outboxes.items()},
+            ('fd',))
 
     def listen(self):
-        """Read status of all open sockets"""
-        self.sckt.listen(5)
-        while self.inputs:
-            readable, writable, exceptional = \
-                select.select(self.inputs, self.clients_to_send, self.inputs)
-
+        """Wait for events on all open sockets and handle them"""
+        if self.sckt is not None:
+            self.selector.register(self.sckt, selectors.EVENT_READ)
+        if self.admin is not None:
+            self.selector.register(self.admin, selectors.EVENT_READ)
+        if self.handoff is not None:
+            self.selector.register(self.handoff, selectors.EVENT_READ)
+        next_tick = None
+        if self.tick:
+            next_tick = time.monotonic() + self.tick
+        while not self.finished():
+            timeout = None
+            if next_tick is not None:
+                timeout = max(0, next_tick - time.monotonic())
+            readable = []
+            writable = []
+            for key, events in self.selector.select(timeout):
+                if events & selectors.EVENT_READ:
+                    readable.append(key.fileobj)
+                if events & selectors.EVENT_WRITE:
+                    writable.append(key.fileobj)
+
+            start = time.perf_counter()
             self.read(readable)
             self.write(writable)
-            self.handle_exceptional(exceptional)
-            if self.win and (len(self.clients_to_send) == 0):
-                break
+            if next_tick is not None and time.monotonic() >= next_tick:
+                self.send_delta()
+                next_tick = max(next_tick + self.tick,
+                                time.monotonic())
+            self.loop_seconds.observe(time.perf_counter() - start)
+        self.selector.close()
+        if self.admin is not None:
+            self.admin.close()
+        if self.journal is not None:
+            self.journal.close()
+
+    def finished(self):
+        """True once the game is won and everyone has been told, or the
+        game has been handed over"""
+        return self.handed_off or (self.win and not self.clients_to_send)
 
     def read(self, readable):
         """Read all incoming messages"""
         for sckt in readable:
             if sckt is self.sckt:
-                (csocket, address) = self.sckt.accept()
-                logging.info('new connection from %s', address)
-                csocket.setblocking(0)
-                self.inputs.append(csocket)
-                self.client_queues[csocket] = queue.Queue()
+                self.accept()
+            elif sckt is self.admin:
+                self.accept_admin()
+            elif sckt in self.admin_conns:
+                self.read_metrics_request(sckt)
+            elif sckt is self.handoff:
+                if self.hand_over():
+                    return  # the rest is read by the new server
             else:
+                decoder = self.decoders[sckt]
                 try:
-                    msg_type, data = receive(sckt)
+                    frames = decoder.recv(sckt)
                 except ConnectionResetError:  # Player left
-                    logging.info('closing %s after reading no data',
-                                 sckt.getpeername())
-
-                    name = self.client_names[sckt]
-                    self.game.delete_player(name)
-                    msg = Msg(b'd', name)
-                    self.send_all(msg)
-
-                    if sckt in self.clients_to_send:
-                        self.clients_to_send.remove(sckt)
-                    self.inputs.remove(sckt)
-                    del self.client_queues[sckt]
-                    del self.client_names[sckt]
-                    sckt.close()
+                    logging.info('closing connection of "%s"',
+                                 self.client_names.get(sckt))
+                    self.remove_client(sckt)
                     continue
+                try:
+                    self.handle_frames(sckt, frames, decoder.sizes)
+                except Exception:  # only this client goes, not the room
+                    logging.exception('failed handling "%s", closing it',
+                                      self.client_names.get(sckt))
+                    if sckt in self.outboxes:
+                        self.remove_client(sckt)
+
+    def handle_frames(self, sckt, frames, sizes):
+        """Handle decoded frames of the given sizes, measuring each"""
+        for (msg_type, data), size in zip(frames, sizes):
+            label = ('in', chr(msg_type[0]))
+            self.messages.inc(label)
+            self.message_bytes.inc(label, size)
+            start = time.perf_counter()
+            self.handle(sckt, msg_type, data)
+            self.handler_seconds.observe(time.perf_counter() - start,
+                                         label[1:])
+        if self.journal is not None:
+            self.journal.commit()  # one write for all the frames
+
+    def accept(self):
+        """Accept every pending connection on the listening socket"""
+        while True:
+            try:
+                (csocket, address) = self.sckt.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            self.adopt(csocket, address)
+
+    def accept_admin(self):
+        """Accept a connection to the metrics port"""
+        try:
+            csocket, _ = self.admin.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        csocket.setblocking(0)
+        self.admin_conns[csocket] = None
+        self.selector.register(csocket, selectors.EVENT_READ)
+
+    def read_metrics_request(self, csocket):
+        """Answer any request on the metrics port with the metrics, which
+        are written out as the socket becomes writable"""
+        try:
+            request = csocket.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            request = b''
+        if not request:
+            self.close_admin(csocket)
+        elif self.admin_conns[csocket] is None:
+            self.admin_conns[csocket] = memoryview(http_response(self.metrics))
+            self.selector.modify(csocket, selectors.EVENT_WRITE)
+
+    def send_metrics(self, csocket):
+        """Send what the socket takes of the metrics answer, closing it
+        once everything is sent"""
+        answer = self.admin_conns[csocket]
+        try:
+            answer = answer[csocket.send(answer):]
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            answer = answer[:0]
+        self.admin_conns[csocket] = answer
+        if not answer:
+            self.close_admin(csocket)
+
+    def close_admin(self, csocket):
+        del self.admin_conns[csocket]
+        self.selector.unregister(csocket)
+        csocket.close()
+
+    def listen_handoff(self, path):
+        """Let a new server take over from this one through the unix
+        socket at path, see handoff"""
+        self.handoff = handoff.listening_socket(path)
+
+    def hand_over(self):
+        """Hand the game and every connection to the server connecting to
+        the handoff socket. Returns True once done, the server then stops
+        without touching the clients"""
+        if self.tick:
+            self.send_delta()
+        if self.journal is not None:
+            self.journal.commit()  # the new server continues it
+        try:
+            done = handoff.hand_over(self)
+        except OSError as exc:
+            logging.warning('handoff failed: %s', exc)
+            done = False
+        if done:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            self.handed_off = True
+            for sckt in self.outboxes:
+                self.outboxes[sckt] = []  # sent by the new server
+            self.clients_to_send.clear()
+        return done
+
+    def adopt(self, csocket, address):
+        """Start serving a connected client socket"""
+        logging.info('new connection from %s', address)
+        csocket.setblocking(0)
+        self.outboxes[csocket] = []
+        self.decoders[csocket] = Decoder(accept=CLIENT_MESSAGES)
+        self.selector.register(csocket, selectors.EVENT_READ)
+
+    def handle(self, sckt, msg_type, data):
+        """Act on a single decoded message from a client"""
+        limiter = self.limiters.get(sckt)
+        if limiter is None:
+            limiter = self.limiters[sckt] = RateLimiter(self.limits)
+        if not limiter.allow(msg_type):
+            self.dropped.inc((chr(msg_type[0]),))
+            if msg_type in (b'm', b'p') and sckt in self.client_names:
+                # every move is answered, so clients can undo their own
+                self.queue_msg(sckt, Msg(b's', "I"))
+            return
+        if msg_type in (b'm', b'p', b'a') and sckt not in self.client_names:
+            return  # not in the game yet
+        if msg_type in (b'j', b'J') and sckt in self.client_names:
+            return  # one player per connection
+
+        if msg_type == b'j':
+            self.add_player(sckt, data)
+
+        elif msg_type == b'J':
+            self.add_player(sckt, data[0], data[1])
+
+        elif msg_type == b'm':
+            # send only move direction, anything but a digit is illegal
+            self.move(sckt, int(data[1]) if data[1].isdigit() else -1)
+
+        elif msg_type == b'p':
+            self.move(sckt, data[1])
+
+        elif msg_type == b'a':
+            self.log_event('interact', sckt)
+            if self.game.interact(self.client_names[sckt], data):
+                None
+
+        elif msg_type == b'M':  # Broadcast message to all players
+            self.log_event('chat', sckt)
+            msg = Msg(b'M', data)
+            self.send_all(msg, sckt)
 
-                if msg_type == b'j':
-                    self.add_player(sckt, data)
-
-                elif msg_type == b'm':
-                    self.move(sckt, int(data[1]))  # send only move direction
-
-                elif msg_type == b'a':
-                    logging.info('received interact request '
-                                 'from %s', sckt.getpeername())
-                    if self.game.interact(self.client_names[sckt], data):
-                        None
-
-                elif msg_type == b'M':  # Broadcast message to all players
-                    logging.info('received message from '
-                                 '"%s", broadcasting', sckt.getpeername())
-                    msg = Msg(b'M', data)
-                    self.send_all(msg, sckt)
-
-    def add_player(self, sckt, name):
-        """send a player join request to all clients"""
+    def remove_client(self, sckt):
+        """Forget a client that has left and tell the others"""
+        name = self.client_names.pop(sckt, None)
+        if name is not None:
+            self.timed('delete_player', self.game.delete_player, name)
+            player_id = self.player_ids.pop(name)
+            if self.journal is not None:
+                self.journal.leave(player_id)
+                self.journal.commit()
+            msg = Msg(b'd', name)
+            compact = Msg(b'x', player_id)
+            self.send_all(msg, sckt, compact)
+        self.versions.pop(sckt, None)
+        self.pages.pop(sckt, None)
+        limiter = self.limiters.pop(sckt, None)
+        if limiter is not None and limiter.dropped():
+            logging.info('dropped messages from "%s" over its rate: %s',
+                         name, limiter.dropped())
+        self.forget(sckt)
+
+    def forget(self, sckt):
+        """Drop all connection state of a client and close it"""
+        self.clients_to_send.discard(sckt)
+        self.selector.unregister(sckt)
+        del self.outboxes[sckt]
+        del self.decoders[sckt]
+        sckt.close()
+
+    def peer(self, sckt):
+        """The address of a client, for logging"""
+        return sckt.getpeername()
+
+    def fileno(self, sckt):
+        """The file descriptor of a client, unique while it is connected"""
+        return sckt.fileno()
+
+    def log_event(self, event, sckt):
+        """Log one in LOG_EVERY events of a kind, as key=value pairs"""
+        self.events[event] += 1
+        if self.events[event] % LOG_EVERY == 1:
+            logging.info('event=%s count=%d client="%s"', event,
+                         self.events[event], self.client_names.get(sckt))
+
+    def timed(self, call, func, *args):
+        """Call a Game method, adding the time it took to its metric"""
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.game_seconds.inc((call,), time.perf_counter() - start)
+
+    def add_player(self, sckt, name, version=1):
+        """send a player join request to all clients. Clients joining with
+        version 2 or later get the compact board instead of the ascii maze,
+        version 3 clients get compact player ids and coordinates"""
         logging.info('received join request with name '
-                     '"%s" from %s', name, sckt.getpeername())
+                     '"%s" from %s', name, self.peer(sckt))
 
-        if name not in self.client_names.values():
+        if self.game.world is not None and version < 3:
+            self.queue_msg(sckt, Msg(b's', "U"))  # world needs version 3
+        elif name not in self.client_names.values():
             self.client_names[sckt] = name
-            msg = Msg(b'w', self.game.mazestr())
-            self.client_queues[sckt].put(msg)
-            pos = self.game.new_player(name)
-            y, x = pos
-            pos = y.to_bytes(1, byteorder='big') + x.to_bytes(1, byteorder='big')
-
-            msg = Msg(b'n', name, pos)
-            self.send_all(msg, sckt)
+            self.player_ids[name] = self.next_id
+            self.next_id += 1
+            version = min(version, PROTOCOL_VERSION)
+            if version >= 2:
+                self.versions[sckt] = version
+                self.queue_msg(sckt, Msg(b'v', version,
+                                         self.player_ids[name]))
+                if self.game.world is None:
+                    self.queue_msg(sckt, Msg(b'b', self.game.board))
+            else:
+                self.queue_msg(sckt, Msg(b'w', self.game.mazestr()))
+            y, x = self.timed('new_player', self.game.new_player, name)
+            if self.journal is not None:
+                self.journal.join(self.player_ids[name], name, y, x)
+            if self.game.world is not None:
+                self.send_page(sckt, y, x)
+
+            msg, compact = self.player_msgs(name, y, x)
+            self.send_all(msg, sckt, compact)
             self.send_players_and_keys(sckt)
 
         else:
             msg = Msg(b's', "T")  # name taken
-            self.client_queues[sckt].put(msg)
-
-        if sckt not in self.clients_to_send:
-            self.clients_to_send.append(sckt)
+            self.queue_msg(sckt, msg)
 
         if len(self.game.players) == 2:
-            upd = self.game.spawn_keys()
+            upd = self.timed('spawn_keys', self.game.spawn_keys)
             if upd:
+                if self.journal is not None:
+                    for y, x in self.game.keys:
+                        self.journal.key(y, x)
                 self.send_keys()
 
     def move(self, sckt, direction):
-        logging.info('received move request '
-                     'from %s', sckt.getpeername())
-        if self.game.move(self.client_names[sckt], direction):
-            msg = Msg(b'm', self.client_names[sckt], direction)
-            self.send_all(msg)
-            key_rem = self.game.check_key(self.client_names[sckt])
+        self.log_event('move', sckt)
+        name = self.client_names[sckt]
+        if self.timed('move', self.game.move, name, direction):
+            if self.journal is not None:
+                self.journal.move(self.player_ids[name], direction)
+            if self.game.world is not None:
+                self.send_page(sckt, *self.game.players[name].pos)
+            msg = Msg(b'm', name, direction)
+            compact = Msg(b'p', self.player_ids[name], direction)
+            self.send_all(msg, compact=compact)
+            if self.tick and self.versions.get(sckt, 1) >= 3:
+                # answer every move at once, clients predict their own
+                self.queue_frame(sckt, compact.encode())
+            key_rem = self.timed('check_key', self.game.check_key, name)
             if key_rem is not None:
-                y, x = key_rem
-                pos = y.to_bytes(1, byteorder='big') + x.to_bytes(1, byteorder='big')
-                msg = Msg(b'k', pos)
-                self.send_all(msg)
+                if self.journal is not None:
+                    self.journal.key(*key_rem)
+                msg, compact = self.key_msgs(*key_rem)
+                self.send_all(msg, compact=compact)
                 if self.game.is_win():
                     self.send_win()
         else:
             msg = Msg(b's', "I")
-            self.client_queues[sckt].put(msg)
-            if sckt not in self.clients_to_send:
-                self.clients_to_send.append(sckt)
-
-    def send_all(self, msg, excl=None):
-        """send a message to every client, excluding excl socket"""
-        for key in self.client_queues:
+            self.queue_msg(sckt, msg)
+
+    def send_page(self, sckt, y, x):
+        """Send the page of the world holding (y, x) to a client, unless
+        it already has it"""
+        origin = (y - y % VIEW[0], x - x % VIEW[1])
+        if self.pages.get(sckt) != origin:
+            self.pages[sckt] = origin
+            board = self.game.world.region(*origin, *VIEW)
+            self.queue_msg(sckt, Msg(b'R', board, origin))
+
+    def send_all(self, msg, excl=None, compact=None):
+        """send a message to every client, excluding excl socket, or the
+        compact message instead to clients speaking protocol version 3.
+        Each message is encoded once and the frame shared by all
+        outboxes. In tick mode compact messages are recorded in the
+        delta of the current tick instead."""
+        frame = msg.encode()
+        batched = self.tick and compact is not None
+        if batched:
+            self.delta.record(compact)
+        else:
+            compact_frame = frame if compact is None else compact.encode()
+        for key in self.outboxes:
             if (excl is not None) and (key == excl):
                 continue
-            self.client_queues[key].put(msg)
-            if key not in self.clients_to_send:
-                self.clients_to_send.append(key)
+            if self.versions.get(key, 1) >= 3:
+                if not batched:
+                    self.queue_frame(key, compact_frame)
+            else:
+                self.queue_frame(key, frame)
+
+    def queue_msg(self, sckt, msg, compact=None):
+        """queue a message for a single client, or the compact message if
+        the client speaks protocol version 3"""
+        if compact is not None and self.versions.get(sckt, 1) >= 3:
+            msg = compact
+        self.queue_frame(sckt, msg.encode())
+
+    def queue_frame(self, sckt, frame):
+        """queue an encoded frame for a single client"""
+        label = ('out', chr(frame[0]))
+        self.messages.inc(label)
+        self.message_bytes.inc(label, len(frame))
+        self.outboxes[sckt].append(frame)
+        self.wake(sckt)
+
+    def wake(self, sckt):
+        """mark a client as having messages waiting to be written"""
+        if sckt not in self.clients_to_send:
+            self.clients_to_send.add(sckt)
+            self.selector.modify(sckt, selectors.EVENT_READ |
+                                 selectors.EVENT_WRITE)
 
     def send_players_and_keys(self, sckt):
         """send all players and keys on board to a single client"""
         for player_name in self.game.players:
             player = self.game.players[player_name]
             y, x = player.pos
-            pos = y.to_bytes(1, byteorder='big') + x.to_bytes(1, byteorder='big')
-            msg = Msg(b'n', player_name, pos)
-            self.client_queues[sckt].put(msg)
-        for key in self.game.keys:
-            y, x = key.pos
-            pos = y.to_bytes(1, byteorder='big') + x.to_bytes(1, byteorder='big')
-            msg = Msg(b'k', pos)
-            self.client_queues[sckt].put(msg)
+            self.queue_msg(sckt, *self.player_msgs(player_name, y, x))
+        for key in self.game.keys.values():
+            self.queue_msg(sckt, *self.key_msgs(*key.pos))
 
     def send_keys(self):
         """send newly spawned keys to all players"""
-        for key in self.game.keys:
-            y, x = key.pos
-            pos = y.to_bytes(1, byteorder='big') + x.to_bytes(1, byteorder='big')
-            msg = Msg(b'k', pos)
-            self.send_all(msg)
+        for key in self.game.keys.values():
+            msg, compact = self.key_msgs(*key.pos)
+            self.send_all(msg, compact=compact)
+
+    def player_msgs(self, name, y, x):
+        """The legacy and compact messages announcing a player"""
+        return (Msg(b'n', name, pos_bytes(y, x)),
+                Msg(b'i', name, (self.player_ids[name], y, x)))
+
+    def key_msgs(self, y, x):
+        """The legacy and compact messages toggling a key"""
+        return (Msg(b'k', pos_bytes(y, x)), Msg(b'K', (y, x)))
+
+    def send_delta(self):
+        """send the changes of the past tick to every version 3 client,
+        as a single delta message"""
+        if not self.delta:
+            return
+        frame = self.delta.msg(self.game, self.player_ids).encode()
+        self.delta = Delta()
+        for key in self.outboxes:
+            if self.versions.get(key, 1) >= 3:
+                self.queue_frame(key, frame)
 
     def send_win(self):
+        if self.tick:
+            self.send_delta()  # the last key before the win
+        if self.journal is not None:
+            self.journal.won()
         msg = Msg(b's', "W")
         self.send_all(msg)
-        is_done_sending = False
-
         self.win = True
 
     def write(self, writable):
-        """write to all sockets that have queued messages"""
+        """write every queued message to each writable socket"""
         for sckt in writable:
+            if sckt in self.admin_conns:
+                self.send_metrics(sckt)
+                continue
+            if sckt not in self.outboxes:
+                continue  # removed earlier in this round
             try:
-                next_msg = self.client_queues[sckt].get_nowait()
-            except queue.Empty:
-                # No messages waiting so stop checking for writability.
-                self.clients_to_send.remove(sckt)
-            else:
-                next_msg.send(sckt)
+                frames = send_frames(sckt, self.outboxes[sckt])
+            except OSError:
+                logging.info('closing connection of "%s" after failed send',
+                             self.client_names.get(sckt))
+                self.remove_client(sckt)
+                continue
 
-    def handle_exceptional(self, exceptional):
-        """Handle "exceptional conditions"""
-        for sckt in exceptional:
-            logging.warning('handling exceptional condition for %s',
-                            sckt.getpeername())
-            # Stop listening for input on the connection
-            self.inputs.remove(sckt)
-            if sckt in self.clients_to_send:
-                self.clients_to_send.remove(sckt)
-            sckt.close()
+            self.outboxes[sckt] = frames
+            if not frames:
+                # Everything sent so stop checking for writability.
+                self.clients_to_send.discard(sckt)
+                self.selector.modify(sckt, selectors.EVENT_READ)
 
-            # Remove message queue
-            del self.client_queues[sckt]
+
+class Delta():
+    """The changes made to the game during one tick. Moves only record
+    which players moved, their final positions are read from the game
+    when the tick is sent, and keys are sent as present or not so a
+    client that got the full state during the tick is not confused."""
+
+    def __init__(self):
+        self.left = set()  # ids
+        self.joined = {}  # id -> name
+        self.moved = set()  # ids
+        self.keys = set()  # positions
+
+    def __bool__(self):
+        return bool(self.left or self.joined or self.moved or self.keys)
+
+    def record(self, compact):
+        """Record the change a compact message would have announced"""
+        if compact.msg_type == b'i':
+            self.joined[compact.msg_2[0]] = compact.msg
+        elif compact.msg_type == b'p':
+            self.moved.add(compact.msg)
+        elif compact.msg_type == b'x':
+            # clients that joined during the tick already know of the
+            # player, so the leave is sent even if the join is not
+            self.moved.discard(compact.msg)
+            self.joined.pop(compact.msg, None)
+            self.left.add(compact.msg)
+        elif compact.msg_type == b'K':
+            self.keys.add(tuple(compact.msg))
+
+    def msg(self, game, player_ids):
+        """The delta message of this tick, given the game state at its
+        end"""
+        names = {player_id: name for name, player_id in player_ids.items()}
+        joins = []
+        for player_id, name in self.joined.items():
+            y, x = game.players[name].pos
+            joins.append((player_id, name, y, x))
+        moves = []
+        for player_id in self.moved - self.joined.keys():
+            y, x = game.players[names[player_id]].pos
+            moves.append((player_id, y, x))
+        keys = [(y, x, (y, x) in game.keys) for y, x in self.keys]
+        return Msg(b'D', (sorted(self.left), joins, moves, keys))
+
+
+def pos_bytes(y, x):
+    """Coordinates as two unsigned bytes, for protocol version 1"""
+    return y.to_bytes(1, byteorder='big') + x.to_bytes(1, byteorder='big')
+
+
+def listening_socket(port, host=''):
+    """Open a non-blocking socket listening on port"""
+    sckt = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sckt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sckt.setblocking(0)
+    sckt.bind((host, port))
+    sckt.listen(socket.SOMAXCONN)
+    return sckt
+
+
+ENGINES = ('select', 'asyncio', 'uvloop')
+
+
+def make_server(engine='select', tick=None, limits=None, port=26000,
+                metrics_port=None, journal=None, world=None):
+    """Create a server running on the named event loop engine"""
+    if engine == 'select':
+        return Server(port, tick, limits, metrics_port, journal, world)
+    from async_server import AsyncServer
+    loop_factory = None
+    if engine == 'uvloop':
+        import uvloop
+        loop_factory = uvloop.new_event_loop
+    return AsyncServer(loop_factory, port, tick, limits, metrics_port,
+                       journal, world)
+
+
+def world_size(text):
+    """ROWSxCOLS from the command line as (rows, cols). Both have to be
+    multiples of the default chunk size"""
+    try:
+        rows, cols = (int(num) for num in text.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected ROWSxCOLS, got %r"
+                                         % text)
+    for size in (rows, cols):
+        if size <= 0 or size % 64:
+            raise argparse.ArgumentTypeError(
+                "world sides are multiples of 64, got %r" % text)
+    return rows, cols
+
+
+def rate_limit(text):
+    """TYPE=RATE/BURST from the command line as (type, (rate, burst))"""
+    try:
+        msg_type, rate = text.split('=')
+        rate, burst = (float(num) for num in rate.split('/'))
+        msg_type = msg_type.encode('ascii')
+    except (ValueError, UnicodeEncodeError):
+        msg_type = None
+    if msg_type is None or len(msg_type) != 1 \
+            or not (rate >= 0 and burst >= 0):
+        raise argparse.ArgumentTypeError("expected TYPE=RATE/BURST, got %r"
+                                         % text)
+    return msg_type, (rate, burst)
+
+
+def directory(text):
+    """A writable directory from the command line"""
+    if not os.path.isdir(text) or not os.access(text, os.W_OK):
+        raise argparse.ArgumentTypeError("%r is not a writable directory"
+                                         % text)
+    return text
 
 
 if __name__ == "__main__":
-    sys.setrecursionlimit(10000)
+    PARSER = argparse.ArgumentParser(description=__doc__)
+    PARSER.add_argument('--engine', choices=ENGINES, default='select',
+                        help='event loop the server runs on')
+    PARSER.add_argument('--port', type=int, default=26000)
+    PARSER.add_argument('--tick-rate', type=float, default=0,
+                        help='delta messages per second sent to version 3 '
+                        'clients, 0 sends every change at once')
+    PARSER.add_argument('--limit', action='append', default=[],
+                        type=rate_limit,
+                        metavar='TYPE=RATE/BURST',
+                        help='messages of a type each client may send per '
+                        'second, and at once, e.g. M=2/5. Repeatable')
+    PARSER.add_argument('--metrics-port', type=int, default=None,
+                        help='serve metrics over HTTP on this port of '
+                        'localhost')
+    PARSER.add_argument('--profile-dir', metavar='DIR', default=None,
+                        type=directory,
+                        help='let SIGUSR2 start and stop a sampling '
+                        'profiler writing its results to DIR')
+    PARSER.add_argument('--journal', metavar='FILE', default=None,
+                        help='append every change to the game to FILE, '
+                        'and recover an unfinished game from it')
+    PARSER.add_argument('--handoff', metavar='PATH', default=None,
+                        help='take over the game of the server waiting on '
+                        'the unix socket PATH, then wait there for the '
+                        'next one. Only with the select engine')
+    PARSER.add_argument('--world', metavar='ROWSxCOLS', type=world_size,
+                        default=None, help='play in a chunked world of '
+                        'this size, multiples of 64, instead of a small '
+                        'maze. Version 3 clients only')
+    ARGS = PARSER.parse_args()
     logging.basicConfig(level=logging.INFO)
-    SERVER = Server()
+    TICK = 1 / ARGS.tick_rate if ARGS.tick_rate > 0 else None
+    RATES = dict(LIMITS)
+    RATES.update(ARGS.limit)
+    TAKEN = None
+    if ARGS.handoff is not None:
+        if ARGS.engine != 'select':
+            PARSER.error('--handoff needs the select engine')
+        try:
+            TAKEN = handoff.take_over(ARGS.handoff)
+        except PermissionError as exc:
+            PARSER.error(str(exc))
+    if TAKEN is None:
+        SERVER = make_server(ARGS.engine, TICK, RATES, ARGS.port,
+                             ARGS.metrics_port, ARGS.journal, ARGS.world)
+    else:
+        SERVER = Server(None, TICK, RATES)
+        handoff.restore(SERVER, *TAKEN)
+        if ARGS.journal is not None:
+            SERVER.open_journal(ARGS.journal, recover=False)
+    if ARGS.handoff is not None:
+        SERVER.listen_handoff(ARGS.handoff)
+    if ARGS.profile_dir is not None:
+        import profiler
+        profiler.install(SERVER, ARGS.profile_dir)
     SERVER.listen()
-    print("The players have won!")
+    if SERVER.handed_off:
+        print("Handed over to the new server")
+    else:
+        print("The players have won!")
@@ -0,0 +1,107 @@
+"""
+Tests for the client's prediction of its own moves.
+
+Authors: Tomass Wilson
+"""
+import pytest
+from client import Prediction
+from game_logic import Game, step
+
+
+def path(game, length):
+    """A start cell and length directions leading on from it without
+    turning back"""
+    for y in range(game.rows):
+        for x in range(game.cols):
+            directions = []
+            pos, back = (y, x), None
+            while len(directions) < length:
+                ahead = [d for d in range(4)
+                         if d != back and not game.wall(*pos, d)]
+                if not ahead:
+                    break
+                directions.append(ahead[0])
+                pos, back = step(*pos, ahead[0]), (ahead[0] + 2) % 4
+            if len(directions) == length:
+                return (y, x), directions
+    raise AssertionError("no path of %d moves" % length)
+
+
+@pytest.fixture
+def game():
+    game = Game()
+    game.genboard(seed=4)
+    return game
+
+
+def joined(game, pos):
+    """A prediction for a player at pos, as after the join"""
+    prediction = Prediction(game, "me")
+    with prediction.update():
+        game.add_player("me", *pos)
+    return prediction
+
+
+def test_echoed_moves(game):
+    start, (first, second) = path(game, 2)
+    prediction = joined(game, start)
+    prediction.predict(first)
+    prediction.predict(second)
+    middle = step(*start, first)
+    end = step(*middle, second)
+    assert game.players["me"].pos == end  # shown before any answer
+
+    with prediction.update():
+        prediction.answered(first)
+    assert game.players["me"].pos == end
+    assert prediction.server_pos == middle
+    with prediction.update():
+        prediction.answered(second)
+    assert game.players["me"].pos == end
+    assert prediction.server_pos == end and not prediction.pending
+
+
+def test_illegal_moves_are_undone(game):
+    start, (first,) = path(game, 1)
+    prediction = joined(game, start)
+    prediction.predict(first)
+    assert game.players["me"].pos == step(*start, first)
+    with prediction.update():
+        prediction.answered()  # the server refused it
+    assert game.players["me"].pos == start and not prediction.pending
+
+    wall = next(d for d in range(4) if game.wall(*start, d))
+    prediction.predict(wall)  # sent, but not shown
+    assert game.players["me"].pos == start
+    with prediction.update():
+        prediction.answered()
+    assert game.players["me"].pos == start and not prediction.pending
+
+
+def test_tick_delta_corrects_the_prediction(game):
+    start, (first, second) = path(game, 2)
+    prediction = joined(game, start)
+    prediction.predict(first)
+    prediction.predict(second)
+    middle = step(*start, first)
+    end = step(*middle, second)
+
+    # in tick mode the mover gets its p at once, the absolute position
+    # of the tick follows in the D message
+    with prediction.update():
+        prediction.answered(first)
+    with prediction.update():
+        game.add_player("me", *middle)  # as Client.apply_delta does
+    assert game.players["me"].pos == end
+    assert prediction.server_pos == middle
+    with prediction.update():
+        prediction.answered(second)
+    with prediction.update():
+        game.add_player("me", *end)
+    assert game.players["me"].pos == end and not prediction.pending
+
+    # a position the prediction did not expect wins over it
+    with prediction.update():
+        game.add_player("me", *start)
+    assert game.players["me"].pos == start
+    assert prediction.server_pos == start
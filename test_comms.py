@@ -0,0 +1,78 @@
+"""
+Tests for encoding and decoding protocol frames.
+
+Authors: Tomass Wilson
+"""
+import pytest
+import maze
+from comms import Decoder, Msg, ProtocolError, CLIENT_MESSAGES
+
+BOARD = maze.generate(15, 21, seed=1)
+
+MESSAGES = [
+    (Msg(b'M', "somebody> hello ünïcode"), "somebody> hello ünïcode"),
+    (Msg(b'j', "somebody"), "somebody"),
+    (Msg(b'J', "somebody", 3), ["somebody", 3]),
+    (Msg(b'm', "somebody", 2), ["somebody", "2"]),
+    (Msg(b'n', "somebody", bytes([7, 11])), ["somebody", 7, 11]),
+    (Msg(b'k', bytes([7, 11])), [7, 11]),
+    (Msg(b'd', "somebody"), "somebody"),
+    (Msg(b's', "W"), "W"),
+    (Msg(b'w', BOARD.render()), BOARD.render()),
+    (Msg(b'v', 3, 300), [3, 300]),
+    (Msg(b'i', "somebody", (300, 700, 1100)), ["somebody", 300, 700, 1100]),
+    (Msg(b'p', 300, 2), [300, 2]),
+    (Msg(b'x', 300), 300),
+    (Msg(b'K', (700, 1100)), [700, 1100]),
+    (Msg(b'D', ([1], [(3, "somebody", 7, 11)], [(4, 5, 6)], [(5, 5, 0)])),
+     [[1], [[3, "somebody", 7, 11]], [[4, 5, 6]], [[5, 5, 0]]]),
+]
+
+
+@pytest.mark.parametrize('msg, expected', MESSAGES,
+                         ids=[msg.msg_type.decode() for msg, _ in MESSAGES])
+def test_round_trip(msg, expected):
+    assert Decoder().feed(msg.encode()) == [(msg.msg_type, expected)]
+
+
+def test_boards_round_trip():
+    frames = Decoder().feed(Msg(b'b', BOARD).encode()
+                            + Msg(b'R', BOARD, (30, 42)).encode())
+    assert frames[0] == (b'b', BOARD)
+    assert frames[1][0] == b'R' and frames[1][1][1:] == [30, 42]
+    assert frames[1][1][0] == BOARD
+
+
+def test_frames_split_anywhere():
+    """Frames arriving a byte at a time come out whole and in order"""
+    data = b''.join(msg.encode() for msg, _ in MESSAGES)
+    decoder = Decoder(size=16)
+    frames = []
+    for num in range(len(data)):
+        frames += decoder.feed(data[num:num + 1])
+    assert frames == [(msg.msg_type, expected) for msg, expected in MESSAGES]
+    assert decoder.pending() == b''
+
+
+def test_partial_frame_is_pending():
+    decoder = Decoder()
+    assert decoder.feed(b'M\x05hel') == []
+    assert decoder.pending() == b'M\x05hel'
+
+
+@pytest.mark.parametrize('data', [
+    b'\xff',  # unknown type
+    b'j\x02\xff\xfe',  # not utf-8
+    b'b\x01\x00\x0f\x00\x15\x00\x00\x00\x04abcd',  # not zlib
+    b'p' + b'\x80' * 10,  # a varint that never ends
+])
+def test_malformed_frames(data):
+    with pytest.raises(ProtocolError):
+        Decoder().feed(data)
+
+
+def test_servers_accept_client_messages_only():
+    decoder = Decoder(accept=CLIENT_MESSAGES)
+    assert decoder.feed(Msg(b'J', "somebody", 3).encode())
+    with pytest.raises(ProtocolError):
+        decoder.feed(b'w')  # refused before the maze has arrived
@@ -0,0 +1,86 @@
+"""
+Tests for the game journal and its replay.
+
+Authors: Tomass Wilson
+"""
+from game_logic import Game, step
+from journal import Journal, Replay
+
+
+def played(path):
+    """Journal a short game, returns the game as it ended"""
+    game = Game()
+    game.genboard(seed=4)
+    journal = Journal(path)
+    journal.board(game)
+    for num, name in enumerate(("ann", "ben")):
+        y, x = game.new_player(name)
+        journal.join(num, name, y, x)
+    for num, name in enumerate(("ann", "ben")):
+        y, x = game.players[name].pos
+        for direction in range(4):
+            if not game.wall(y, x, direction) and \
+                    step(y, x, direction) not in game.occupied:
+                game.move(name, direction)
+                journal.move(num, direction)
+                break
+    for y, x in ((0, 0), (1, 1), (2, 2)):
+        game.toggle_key(y, x)
+        journal.key(y, x)
+    game.toggle_key(1, 1)
+    journal.key(1, 1)
+    journal.commit()
+    game.delete_player("ben")
+    journal.leave(1)
+    journal.close()
+    return game
+
+
+def test_replay_rebuilds_the_game(tmp_path):
+    path = str(tmp_path / "game.journal")
+    game = played(path)
+    replay = Replay(path).run()
+    assert replay.game.board == game.board
+    assert set(replay.game.keys) == set(game.keys)
+    assert {name: plyr.pos for name, plyr in replay.game.players.items()} \
+        == {name: plyr.pos for name, plyr in game.players.items()}
+    assert replay.names == {0: "ann"} and replay.next_id == 2
+    assert replay.events == 10
+
+
+def test_offset_stops_before_a_record(tmp_path):
+    path = str(tmp_path / "game.journal")
+    played(path)
+    for events in range(1, 11):
+        by_count = Replay(path).run(events=events)
+        by_offset = Replay(path).run(offset=by_count.offset + 1)
+        assert by_offset.events == events
+        assert by_offset.offset == by_count.offset
+        assert set(by_offset.game.keys) == set(by_count.game.keys)
+    assert Replay(path).run(offset=4).game is None
+
+
+def test_torn_record_is_cut_off(tmp_path):
+    path = str(tmp_path / "game.journal")
+    played(path)
+    size = Replay(path).run().offset
+    with open(path, "ab") as journal:
+        journal.write(b'J\x05')
+    journal = Journal(path)
+    assert journal.recovered.offset == size
+    assert set(journal.recovered.game.players) == {"ann"}
+    journal.close()
+    assert Replay(path).run().offset == size
+
+
+def test_world_games_replay(tmp_path):
+    path = str(tmp_path / "world.journal")
+    game = Game()
+    game.genworld(128, 128, seed=9)
+    journal = Journal(path)
+    journal.board(game)
+    journal.join(0, "far", 100, 100)
+    journal.close()
+    replay = Replay(path).run()
+    assert replay.game.world.seed == 9
+    assert replay.game.players["far"].pos == (100, 100)
@@ -0,0 +1,45 @@
+"""
+Tests for maze generation and the paths through a maze.
+
+Authors: Tomass Wilson
+"""
+import pytest
+import maze
+from paths import MazeGraph, DistanceOracle
+
+SHAPES = [(1, 1), (5, 1), (1, 5), (2, 2), (15, 21), (33, 7)]
+
+
+@pytest.mark.parametrize('algorithm', sorted(maze.ALGORITHMS))
+@pytest.mark.parametrize('rows, cols', SHAPES)
+def test_generated_mazes_are_perfect(algorithm, rows, cols):
+    """Every cell is reachable, through exactly one path"""
+    board = maze.generate(rows, cols, seed=7, algorithm=algorithm)
+    graph = MazeGraph(board)
+    assert len(graph.indices) // 2 == rows * cols - 1
+    assert min(graph.bfs([(0, 0)])) >= 0
+    assert board.hor[0].all() and board.hor[rows].all()
+    assert board.ver[:, 0].all() and board.ver[:, cols].all()
+
+
+@pytest.mark.parametrize('algorithm', sorted(maze.ALGORITHMS))
+def test_same_seed_same_maze(algorithm):
+    assert maze.generate(15, 21, 3, algorithm) == \
+        maze.generate(15, 21, 3, algorithm)
+
+
+def test_ascii_round_trip():
+    board = maze.generate(15, 21, seed=1)
+    assert maze.read_maze(maze.draw_maze(board)) == board
+
+
+def test_oracle_matches_bfs():
+    board = maze.generate(15, 21, seed=2)
+    graph = MazeGraph(board)
+    oracle = DistanceOracle(graph)
+    dist = graph.distance_grid([(3, 4)])
+    for y in range(15):
+        for x in range(21):
+            assert oracle.distance((3, 4), (y, x)) == dist[y, x]
+            path = oracle.path((3, 4), (y, x))
+            assert len(path) == dist[y, x] + 1
@@ -0,0 +1,270 @@
+"""
+Tests for the game server, run against every event loop engine over real
+sockets.
+
+Authors: Tomass Wilson
+"""
+import argparse
+import os
+import socket
+import threading
+import pytest
+import comms
+import handoff
+from comms import Decoder, Msg, BOARD_HEADER
+from game_logic import step
+from server import make_server, rate_limit, Delta, VIEW
+
+ENGINES = ('select', 'asyncio')
+
+
+class Peer():
+    """A minimal blocking client"""
+
+    def __init__(self, port):
+        self.sckt = socket.create_connection(('localhost', port), timeout=5)
+        self.decoder = Decoder()
+        self.frames = []
+
+    def send(self, frame):
+        if isinstance(frame, Msg):
+            frame = frame.encode()
+        self.sckt.sendall(frame)
+
+    def expect(self, msg_type, match=lambda msg: True, until=None):
+        """The next message of msg_type for which match is true, skipping
+        everything before it. None if a message of type until comes
+        first"""
+        while True:
+            while self.frames:
+                frame_type, msg = self.frames.pop(0)
+                if frame_type == msg_type and match(msg):
+                    return msg
+                if frame_type == until:
+                    return None
+            data = self.sckt.recv(65536)
+            assert data, "connection closed waiting for %r" % msg_type
+            self.frames.extend(self.decoder.feed(data))
+
+    def join(self, name):
+        """Join with protocol version 3, returns the id, the board and
+        the position of the own player"""
+        self.send(Msg(b'J', name, 3))
+        _, player_id = self.expect(b'v')
+        board = self.expect(b'b')
+        _, _, y, x = self.expect(b'i', lambda msg: msg[1] == player_id)
+        return player_id, board, (y, x)
+
+    def closed(self):
+        """True if the server closes the connection"""
+        try:
+            while self.sckt.recv(65536):
+                pass
+        except ConnectionResetError:
+            pass
+        return True
+
+
+def start(engine, **options):
+    """A server on a free port, listening in a thread"""
+    srv = make_server(engine, port=0, **options)
+    thread = threading.Thread(target=srv.listen, daemon=True)
+    thread.start()
+    srv.port_number = srv.sckt.getsockname()[1]
+    srv.thread = thread
+    return srv
+
+
+@pytest.fixture(params=ENGINES)
+def server(request):
+    return start(request.param)
+
+
+def open_side(board, y, x):
+    """A direction without a wall from (y, x)"""
+    walls = (board.hor[y, x], board.ver[y, x + 1],
+             board.hor[y + 1, x], board.ver[y, x])
+    return next(d for d in range(4) if not walls[d])
+
+
+@pytest.mark.parametrize('attack', [
+    b'\xff',  # unknown message type
+    b'j\x02\xff\xfe',  # name that is not utf-8
+    b'b' + BOARD_HEADER.pack(1, 60000, 60000, 2 ** 32 - 1),  # server only
+])
+def test_hostile_client_only_loses_itself(server, attack):
+    good = Peer(server.port_number)
+    player_id, board, (y, x) = good.join("good")
+    hostile = Peer(server.port_number)
+    hostile.send(Msg(b'p', 0, 1))  # moves before joining are ignored
+    hostile.send(b'm\x04good1')
+    hostile.send(attack)
+    assert hostile.closed()
+
+    good.send(Msg(b'p', player_id, open_side(board, y, x)))
+    assert good.expect(b'p') == [player_id, open_side(board, y, x)]
+    other = Peer(server.port_number)
+    other.join("other")
+    assert server.thread.is_alive()
+
+
+
+def test_one_player_per_connection(server):
+    peer = Peer(server.port_number)
+    player_id, board, (y, x) = peer.join("first")
+    for num in range(30):
+        peer.send(Msg(b'J', "ghost%d" % num, 3))
+    direction = open_side(board, y, x)
+    peer.send(Msg(b'p', player_id, direction))  # handled after the joins
+    assert peer.expect(b'p') == [player_id, direction]
+    assert list(server.game.players) == ["first"]
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_world_room_sends_pages(engine):
+    srv = start(engine, world=(128, 128), limits={})
+    peer = Peer(srv.port_number)
+    peer.send(Msg(b'J', "explorer", 3))
+    _, player_id = peer.expect(b'v')
+    board, top, left = peer.expect(b'R')
+    _, _, y, x = peer.expect(b'i', lambda msg: msg[1] == player_id)
+    assert (board.rows, board.cols) == VIEW
+    assert top <= y < top + VIEW[0] and left <= x < left + VIEW[1]
+
+    # follow the right hand wall until the player is on another page,
+    # which is sent before the answer to the move
+    heading = 0
+    for _ in range(2 * VIEW[0] * VIEW[1]):
+        heading = next((heading + turn) % 4 for turn in (1, 0, 3, 2)
+                       if not srv.game.wall(y, x, (heading + turn) % 4))
+        peer.send(Msg(b'p', player_id, heading))
+        frame = peer.expect(b'R', until=b'p')
+        y, x = step(y, x, heading)
+        if frame is not None:
+            break
+    assert frame[1:] != [top, left]
+    assert frame[1] <= y < frame[1] + VIEW[0]
+    assert frame[2] <= x < frame[2] + VIEW[1]
+
+    old = Peer(srv.port_number)
+    old.send(Msg(b'J', "oldtimer", 2))
+    assert old.expect(b's') == "U"
+
+
+def test_join_move_win(server):
+    alice = Peer(server.port_number)
+    player_id, board, (y, x) = alice.join("alice")
+    direction = open_side(board, y, x)
+    key = step(y, x, direction)
+    server.game.toggle_key(*key)  # the server is idle, waiting for us
+    server.game.keys_spawned = True
+
+    bob = Peer(server.port_number)
+    bob.send(Msg(b'j', "bob"))  # protocol version 1
+    assert len(bob.expect(b'w')) == comms.MAZE_LEN
+    assert bob.expect(b'n', lambda msg: msg[0] == "alice")[1:] == [y, x]
+    assert bob.expect(b'k') == list(key)
+    assert alice.expect(b'i', lambda msg: msg[0] == "bob")
+
+    alice.send(Msg(b'p', player_id, direction))
+    assert alice.expect(b'p') == [player_id, direction]
+    assert alice.expect(b'K') == list(key)
+    assert alice.expect(b's') == "W"
+    assert bob.expect(b'm') == ["alice", str(direction)]
+    assert bob.expect(b'k') == list(key)
+    assert bob.expect(b's') == "W"
+    server.thread.join(5)
+    assert not server.thread.is_alive()
+
+
+def test_illegal_move_is_answered(server):
+    peer = Peer(server.port_number)
+    player_id, board, (y, x) = peer.join("walker")
+    walls = [d for d in range(4) if server.game.wall(y, x, d)]
+    peer.send(Msg(b'p', player_id, walls[0]))
+    assert peer.expect(b's') == "I"
+    peer.send(b'm\x06walkerq')  # not a direction at all
+    assert peer.expect(b's') == "I"
+
+
+def test_handoff_keeps_clients(tmp_path):
+    path = str(tmp_path / "handoff.sock")
+    old = make_server('select', port=0)
+    old.listen_handoff(path)
+    thread = threading.Thread(target=old.listen, daemon=True)
+    thread.start()
+    peer = Peer(old.sckt.getsockname()[1])
+    player_id, board, (y, x) = peer.join("stayer")
+    peer.send(b'M\x05hel')  # half a chat message, the new server reads on
+
+    new = make_server('select', port=None)
+    handoff.restore(new, *handoff.take_over(path))
+    thread.join(5)
+    assert old.handed_off and not thread.is_alive()
+    threading.Thread(target=new.listen, daemon=True).start()
+
+    assert new.game.players["stayer"].pos == (y, x)
+    peer.send(b'lo')
+    direction = open_side(board, y, x)
+    peer.send(Msg(b'p', player_id, direction))
+    assert peer.expect(b'p') == [player_id, direction]
+    assert new.game.players["stayer"].pos == step(y, x, direction)
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_metrics_label_every_connection(engine):
+    srv = start(engine, metrics_port=0)
+    joined = Peer(srv.port_number)
+    joined.join("joined")
+    lurkers = [Peer(srv.port_number) for _ in range(2)]  # not in the game
+    for lurker in lurkers:
+        lurker.send(Msg(b'M', "hi"))
+        assert joined.expect(b'M') == "hi"
+    admin = socket.create_connection(srv.admin.getsockname(), timeout=5)
+    admin.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+    answer = b''
+    while True:
+        data = admin.recv(65536)
+        if not data:
+            break
+        answer += data
+    assert answer.startswith(b'HTTP/1.0 200 OK')
+    samples = [line for line in answer.decode().splitlines()
+               if line.startswith('maze_outbox_frames{')]
+    assert len(samples) == 3
+
+
+def test_rate_limit_argument():
+    assert rate_limit("M=2/5") == (b'M', (2.0, 5.0))
+    for text in ("M=2", "M=a/b", "MM=1/1", "M=-1/2"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            rate_limit(text)
+
+
+def test_handoff_only_to_the_same_user(tmp_path, monkeypatch):
+    path = str(tmp_path / "handoff.sock")
+    listener = handoff.listening_socket(path)
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    uid = os.getuid()
+    monkeypatch.setattr(os, 'getuid', lambda: uid + 1)  # another user
+    with pytest.raises(PermissionError):
+        handoff.take_over(path)
+    listener.close()
+
+
+def test_delta_keeps_leaves_of_new_players():
+    delta = Delta()
+    delta.record(Msg(b'i', "ann", (0, 3, 4)))
+    delta.record(Msg(b'p', 0, 1))
+    delta.record(Msg(b'x', 0))
+    assert delta.msg(None, {}).msg == ([0], [], [], [])
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_leave_in_the_join_tick_is_sent(engine):
+    srv = start(engine, tick=0.5)
+    ann = Peer(srv.port_number)
+    ann_id = ann.join("ann")[0]
+    ben = Peer(srv.port_number)
+    ben.join("ben")
+    ann.sckt.close()
+    assert ben.expect(b'D', lambda msg: msg[0])[0] == [ann_id]
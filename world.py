@@ -0,0 +1,141 @@
+"""
+The world module holds mazes too big to generate up front. The world is
+cut into square chunks that are generated the first time something touches
+them and dropped again when nobody is near, to be regenerated identically
+from the seed if they are needed later.
+
+Every chunk is its own perfect maze, built row by row with Eller's
+algorithm from a seed derived from the world seed and the chunk position.
+Chunks are joined by a single door to the chunk north or west of them, so
+the doors form a tree over the chunks and the whole world is still a
+perfect maze. A door only depends on the seed and the position of its
+chunk, so neighbouring chunks agree on their border without either having
+to be loaded.
+"""
+import random
+import numpy as np
+import maze
+
+
+class ChunkedWorld():
+    """A maze of rows x cols cells, generated chunk_size x chunk_size cells
+    at a time. rows and cols must be multiples of chunk_size"""
+
+    def __init__(self, rows, cols, seed=None, chunk_size=64):
+        if rows % chunk_size or cols % chunk_size:
+            raise ValueError("world size must be a multiple of the chunk size")
+        self.rows = rows
+        self.cols = cols
+        self.seed = random.getrandbits(64) if seed is None else seed
+        self.chunk_size = chunk_size
+        self.chunks = {}  # (cy, cx) -> maze.Board
+
+    def chunk(self, cy, cx):
+        """The board of a chunk, generating it if it is not loaded"""
+        board = self.chunks.get((cy, cx))
+        if board is None:
+            board = maze.generate(self.chunk_size, self.chunk_size,
+                                  "%d:%d:%d" % (self.seed, cy, cx), 'eller')
+            self.chunks[(cy, cx)] = board
+        return board
+
+    def touch(self, y, x):
+        """Make sure the chunk holding cell (y, x) is loaded"""
+        self.chunk(y // self.chunk_size, x // self.chunk_size)
+
+    def door(self, cy, cx):
+        """
+        The door joining a chunk to the rest of the world
+
+        returns:
+            ("north", x) or ("west", y) with the position of the door along
+            the chunk border, or None for the first chunk
+        """
+        if cy == 0 and cx == 0:
+            return None
+        rng = random.Random("%d:%d:%d:door" % (self.seed, cy, cx))
+        if cy == 0:
+            side = "west"
+        elif cx == 0:
+            side = "north"
+        else:
+            side = rng.choice(("north", "west"))
+        return (side, rng.randrange(self.chunk_size))
+
+    def north_wall(self, y, x):
+        """True if cell (y, x) has a wall on its north side"""
+        if y == self.rows:
+            return True  # south border of the world
+        size = self.chunk_size
+        cy, ly = divmod(y, size)
+        cx, lx = divmod(x, size)
+        if ly == 0:
+            return self.door(cy, cx) != ("north", lx)
+        return bool(self.chunk(cy, cx).hor[ly, lx])
+
+    def west_wall(self, y, x):
+        """True if cell (y, x) has a wall on its west side"""
+        if x == self.cols:
+            return True  # east border of the world
+        size = self.chunk_size
+        cy, ly = divmod(y, size)
+        cx, lx = divmod(x, size)
+        if lx == 0:
+            return self.door(cy, cx) != ("west", ly)
+        return bool(self.chunk(cy, cx).ver[ly, lx])
+
+    def wall(self, y, x, direction):
+        """True if there is a wall on side direction (NESW as 0-3) of
+        cell (y, x)"""
+        if direction == 0:
+            return self.north_wall(y, x)
+        if direction == 1:
+            return self.west_wall(y, x + 1)
+        if direction == 2:
+            return self.north_wall(y + 1, x)
+        return self.west_wall(y, x)
+
+    def region(self, y0, x0, rows, cols):
+        """A maze.Board of the rows x cols cells starting at (y0, x0)"""
+        size = self.chunk_size
+        # north and west walls of one extra row and column of cells, which
+        # hold the south and east walls of the region
+        north = np.ones((rows + 1, cols + 1), dtype=bool)
+        west = np.ones((rows + 1, cols + 1), dtype=bool)
+        y1 = min(y0 + rows + 1, self.rows)
+        x1 = min(x0 + cols + 1, self.cols)
+        for cy in range(y0 // size, (y1 - 1) // size + 1):
+            for cx in range(x0 // size, (x1 - 1) // size + 1):
+                board = self.chunk(cy, cx)
+                top, left = cy * size, cx * size
+                ys = slice(max(y0, top), min(y1, top + size))
+                xs = slice(max(x0, left), min(x1, left + size))
+                into = (slice(ys.start - y0, ys.stop - y0),
+                        slice(xs.start - x0, xs.stop - x0))
+                local = (slice(ys.start - top, ys.stop - top),
+                         slice(xs.start - left, xs.stop - left))
+                north[into] = board.hor[local]
+                west[into] = board.ver[local]
+
+                door = self.door(cy, cx)
+                if door is None:
+                    continue
+                side, offset = door
+                y, x = (top, left + offset) if side == "north" \
+                    else (top + offset, left)
+                if ys.start <= y < ys.stop and xs.start <= x < xs.stop:
+                    walls = north if side == "north" else west
+                    walls[y - y0, x - x0] = False
+        return maze.Board(north[:, :cols], west[:rows, :])
+
+    def evict(self, positions, radius=1):
+        """Drop every chunk further than radius chunks from all positions"""
+        size = self.chunk_size
+        near = set()
+        for y, x in positions:
+            cy, cx = y // size, x // size
+            for dy in range(-radius, radius + 1):
+                for dx in range(-radius, radius + 1):
+                    near.add((cy + dy, cx + dx))
+        for pos in [pos for pos in self.chunks if pos not in near]:
+            del self.chunks[pos]